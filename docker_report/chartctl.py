@@ -25,8 +25,9 @@ import logging
 import os
 import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Optional
+from typing import Iterator, List, Optional
 
 from docker_report import setup_logging, CustomFormatter
 from docker_report.helm import HelmError, get_chart_name_version, package_chart
@@ -34,17 +35,41 @@ from docker_report.helm.chartmuseum import Chartmuseum, ChartmuseumError
 
 logger = logging.getLogger("helm-chartctl")
 
+# Available actions, with the help text of their PATH argument.
+ACTIONS = {
+    "push": "Path to the chart to package and push",
+    "walk": "Path to walk for charts",
+    "upload": "Path to the chart tgz to upload",
+}
+
+
+def _requested_action(args: List[str]) -> Optional[str]:
+    """Peek at the command line to find the requested action, if it's a valid one."""
+    skip_value = False
+    for arg in args:
+        if skip_value:
+            skip_value = False
+        elif arg.startswith(("--cm", "--concurrency")) and "=" not in arg:
+            # All the --cm-* options and --concurrency take a value as the next argument.
+            skip_value = True
+        elif not arg.startswith("-"):
+            return arg if arg in ACTIONS else None
+    return None
+
 
 def parse_args(args: Optional[List] = None) -> argparse.Namespace:
     """Parse arguments."""
+    if args is None:
+        args = sys.argv[1:]
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=CustomFormatter)
     actions = parser.add_subparsers(dest="action", help="The action to perform")
-    push = actions.add_parser("push")
-    push.add_argument("path", metavar="PATH", type=Path, help="Path to the chart to package and push")
-    walk = actions.add_parser("walk")
-    walk.add_argument("path", metavar="PATH", type=Path, help="Path to walk for charts")
-    upload = actions.add_parser("upload")
-    upload.add_argument("path", metavar="PATH", type=Path, help="Path to the chart tgz to upload")
+    # Only build the subparser for the requested action; all of them are needed
+    # to show the help or to report an invalid choice.
+    requested = _requested_action(args)
+    for action, path_help in ACTIONS.items():
+        if requested is None or action == requested:
+            subparser = actions.add_parser(action)
+            subparser.add_argument("path", metavar="PATH", type=Path, help=path_help)
 
     cm = parser.add_argument_group()
     cm.add_argument(
@@ -70,6 +95,9 @@ def parse_args(args: Optional[List] = None) -> argparse.Namespace:
         default=os.environ.get("HELM_REPO_PASSWORD"),
         help="Password for chartmuseum basic auth (env: $HELM_REPO_PASSWORD)",
     )
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="Maximum number of charts to package and push in parallel (walk)."
+    )
 
     log = parser.add_mutually_exclusive_group()
     log.add_argument("--debug", "-d", action="store_true", default=False, help="enable debugging")
@@ -98,29 +126,60 @@ def push(cm: Chartmuseum, repository: str, path: Path):
     shutil.rmtree(chart_tgz.parent)
 
 
-def walk(cm: Chartmuseum, repository: str, path: Path):
+def _find_chart_yamls(root: Path) -> Iterator[Path]:
+    """Find all Chart.yaml files under root, skipping hidden directories (like .git)"""
+    stack = [str(root)]
+    while stack:
+        scanner = os.scandir(stack.pop())
+        try:
+            for entry in scanner:
+                # DirEntry caches the file type from the directory listing, so this doesn't need a stat call
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith("."):
+                        stack.append(entry.path)
+                elif entry.name == "Chart.yaml" and entry.is_file():
+                    yield Path(entry.path)
+        finally:
+            scanner.close()
+
+
+def walk(cm: Chartmuseum, repository: str, path: Path, concurrency: int = 8):
     """Walk a directory for charts to package and push"""
-    repo = cm.get_charts(repository)
-    for chart_yaml in Path(path).rglob("Chart.yaml"):
+    index = cm.index_repo(cm.get_charts(repository))
+    to_push = []
+    for chart_yaml in _find_chart_yamls(path):
         name, version = get_chart_name_version(chart_yaml)
-        if not cm.is_version_in_repo(repo, name, version):
-            # Package and push the new chart version
-            push(cm, repository, chart_yaml.parent)
+        if (name, version) not in index:
+            to_push.append(chart_yaml.parent)
         else:
             logger.info("%s-%s already exists in repo: %s", name, version, repository)
 
+    # Package and push the new chart versions. Both helm and the upload are I/O bound,
+    # so run them in parallel.
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(push, cm, repository, chart_path): chart_path for chart_path in to_push}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                logger.error("Failed to package and push %s", futures[future])
+                # Don't start working on the charts still in the queue
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+
 
 def main(args=None):
     options = parse_args(args)
     setup_logging(logger, options, logging.ERROR)
     retcode = 0
+    cm = None  # type: Optional[Chartmuseum]
 
     try:
         cm = Chartmuseum(options.cm_url, options.cm_user, options.cm_password, logger=logger)
         if options.action == "push":
             push(cm, options.repository, options.path)
         elif options.action == "walk":
-            walk(cm, options.repository, options.path)
+            walk(cm, options.repository, options.path, options.concurrency)
         elif options.action == "upload":
             upload(cm, options.repository, options.path)
     except ChartmuseumError:
@@ -132,6 +191,9 @@ def main(args=None):
     except Exception:
         logger.exception("Generic unhandled error")
         retcode = 1
+    finally:
+        if cm is not None:
+            cm.close()
     sys.exit(retcode)
 
 
@@ -22,86 +22,129 @@ Takes 2 arguments - the image full name and the directory where to store the
 report.
 """
 import argparse
+import functools
+import io
 import logging
 import os
 import shutil
 import subprocess
 import sys
-from io import BytesIO
-from tarfile import TarFile
-from typing import List, Tuple
-
-import docker  # type: ignore
+import tarfile
+from typing import Iterable, List, Tuple
 
 from docker_report import CustomFormatter, setup_logging
 
-logger = logging.getLogger(os.path.splitext(os.path.basename(sys.argv[0]))[0])
+# A child of the docker-report logger, so that messages propagate to its handlers when
+# DockerReport is used by docker-report.
+logger = logging.getLogger("docker-report.debmonitor")
 
 
-def parse_args(args: List[str]) -> argparse.Namespace:
-    """Parse arguments."""
+@functools.lru_cache(maxsize=None)
+def _parser() -> argparse.ArgumentParser:
+    """Build the argument parser, only once."""
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=CustomFormatter)
     parser.add_argument("image_name", metavar="IMAGE_NAME", help="The full name:tag of the image")
     parser.add_argument("report_dir", metavar="DIR", help="The directory where the report will be temporarily stored.")
     parser.add_argument("--keep", action="store_true", help="Keep the generated report even after submitting it.")
     parser.add_argument("--no-submit", "-n", action="store_true", help="Do not submit the report, just generate it.")
+    parser.add_argument(
+        "--force-pull", action="store_true", help="Pull the image even if it's already present on the local host."
+    )
     parser.add_argument(
         "--minimum-debian-version", default=10, help="Minimum Debian major version that is considered supported."
     )
     log = parser.add_mutually_exclusive_group()
     log.add_argument("--debug", "-d", action="store_true", default=False, help="enable debugging")
     log.add_argument("--silent", "-s", action="store_true", default=False, help="don't log to console")
-    return parser.parse_args(args)
+    return parser
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    """Parse arguments."""
+    return _parser().parse_args(args)
 
 
 class DockerReportError(Exception):
     pass
 
 
+@functools.lru_cache(maxsize=1)
+def _docker_client():
+    """The docker client, shared by all DockerReport instances."""
+    # Imported here so that parsing the command line doesn't pay for loading the docker SDK.
+    import docker  # type: ignore
+
+    return docker.from_env()
+
+
+class _ChunksReader(io.RawIOBase):
+    """Read-only, non-seekable file object over an iterable of bytes chunks."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        # A memoryview allows to consume the current chunk without copying what's left of it on every read.
+        self._buffer = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._buffer:
+            try:
+                self._buffer = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
 class DockerReport:
     """Reports content of a docker image to debmonitor."""
 
-    def __init__(self, image_name: str, report_dir: str, minimum_major: int):
+    def __init__(self, image_name: str, report_dir: str, minimum_major: int, force_pull: bool = False):
         self.image = image_name
         self.report_dir = report_dir
         self.proxy = os.environ.get("http_proxy")
         self.file_basename = "{}.debmonitor.json".format(self.image.replace("/", "-"))
         self.filename = os.path.join(self.report_dir, self.file_basename)
-        self.client = docker.from_env()
+        self.client = _docker_client()
         self.minimum_version = (minimum_major, 0)
+        self.force_pull = force_pull
 
     @staticmethod
-    def _cmd_run(cmd: List) -> bytes:
-        # TODO: use subprocess.run when we're past python 3.5
-        return subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+    def _cmd_run(cmd: List) -> subprocess.CompletedProcess:
+        return subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
     def _cmd(self, label: str, cmd: List) -> bytes:
-        """Simplistic wrapper around subprocess."""
+        """Simplistic wrapper around subprocess, returns the command's stdout."""
         try:
             logger.info("Running: %s", label.lower())
-            out = self._cmd_run(cmd)
-            logger.debug(out.decode("utf-8"))
-            return out
+            res = self._cmd_run(cmd)
+            logger.debug(res.stderr.decode("utf-8"))
+            return res.stdout
         except subprocess.CalledProcessError as e:
             logger.error("%s exited with exit code %d. Output:", label, e.returncode)
             logger.error(e.stdout.decode("utf-8"))
+            logger.error(e.stderr.decode("utf-8"))
             raise DockerReportError(label)
 
     def _docker_cmd(self) -> List[str]:
         """Generates the docker command to run."""
-        container_filename = os.path.join("/mnt", self.file_basename)
         if self.proxy is not None:
             logger.debug("proxy set to: %s", self.proxy)
             proxy_inject = "echo 'Acquire::http::Proxy \"{}\";' > /etc/apt/apt.conf.d/80_proxy".format(self.proxy)
         else:
-            proxy_inject = "echo 'No proxy configured'"
+            proxy_inject = "echo 'No proxy configured' >&2"
 
-        # This is the command to run inside the docker image
+        # This is the command to run inside the docker image. The report is the only thing
+        # written to stdout, everything else goes to stderr.
         bash_incantation = [
             proxy_inject,
-            "apt-get update",
-            "apt-get install --yes --no-install-recommends debmonitor-client",
-            "/usr/bin/debmonitor-client -n -i '{img}' > '{fname}'".format(img=self.image, fname=container_filename),
+            "apt-get update >&2",
+            "apt-get install --yes --no-install-recommends debmonitor-client >&2",
+            "/usr/bin/debmonitor-client -n -i '{img}'".format(img=self.image),
         ]
 
         return [
@@ -110,8 +153,6 @@ class DockerReport:
             "--user",
             "root",
             "--rm",
-            "-v",
-            "{}:/mnt:rw".format(self.report_dir),
             "--entrypoint",
             "/bin/bash",
             "{}".format(self.image),
@@ -121,54 +162,84 @@ class DockerReport:
 
     def _extract_debian_version(self, dv_stream) -> Tuple[int, int]:
         """Extract the debian version number (tuple of two integers) from get_archive stream"""
-        tar_bytes = BytesIO()
         try:
-            for chunk in dv_stream:
-                tar_bytes.write(chunk)
-            tar_bytes.seek(0)
-            dv_tar = TarFile(fileobj=tar_bytes)
-            dv_bytes = dv_tar.extractfile("debian_version")
-            if not dv_bytes:
-                raise KeyError("debian_version is not a regular file")
-            dv = dv_bytes.read().decode("utf-8")
-        except (KeyError, OSError) as e:
-            # Tarfile.extractfile raises KeyError in case the archive does not contain the requested file
+            # Read the archive as a stream, there is no need to buffer it in memory first.
+            with tarfile.open(fileobj=_ChunksReader(dv_stream), mode="r|") as dv_tar:
+                for member in dv_tar:
+                    if member.name == "debian_version":
+                        break
+                else:
+                    raise KeyError("debian_version not found in the archive")
+                dv_bytes = dv_tar.extractfile(member)
+                if not dv_bytes:
+                    raise KeyError("debian_version is not a regular file")
+                dv = dv_bytes.read().decode("utf-8")
+        except (KeyError, OSError, tarfile.TarError) as e:
             raise DockerReportError("Failed to extract debian_version from image") from e
         major, minor = map(int, (dv.split(".")))
         return (major, minor)
 
+    def _pull_image(self):
+        """Pull the image, unless it's already present locally and force_pull is not set."""
+        from docker.errors import ImageNotFound  # type: ignore
+
+        api = self.client.api
+        if not self.force_pull:
+            try:
+                api.inspect_image(self.image)
+                logger.debug("Image %s is already present locally, not pulling it", self.image)
+                return
+            except ImageNotFound:
+                pass
+        logger.debug("Pulling image %s", self.image)
+        # Consume the progress output to wait for the pull to complete. Failures like a missing
+        # manifest or a denied request are reported in the stream, not raised.
+        for progress in api.pull(self.image, stream=True, decode=True):
+            if "error" in progress:
+                raise DockerReportError("Failed to pull {}: {}".format(self.image, progress["error"]))
+
     def is_supported_image(self):
         """Check if self.image is a debian image which we can generate reports for."""
+        from docker.errors import NotFound  # type: ignore
 
+        # Use the low-level API client: the high-level one inspects the image and the container
+        # after pulling/creating them, only to build wrapper objects we don't need.
+        api = self.client.api
         try:
-            # containers.create does not pull the image, so we need to pull manually
-            self.client.images.pull(self.image)
+            # create_container does not pull the image, so we need to pull manually
+            self._pull_image()
 
             # The container is not actually run but docker daemon complains about missing command
             # sometimes (maybe if the image does not have an entrypoint defined.
             # To prevent this, "/false" is given as command.
-            container = self.client.containers.create(self.image, command="/false")
+            container_id = api.create_container(self.image, command="/false")["Id"]
         except Exception as e:
             logger.error("Failed to pull/create image %s: %s", self.image, e)
             return False
 
         try:
-            dv_stream, _ = container.get_archive("/etc/debian_version")
+            dv_stream, _ = api.get_archive(container_id, "/etc/debian_version")
             debian_version = self._extract_debian_version(dv_stream)
             logger.debug("Image %s is Debian version %s", self.image, debian_version)
-        except docker.errors.NotFound:
+        except NotFound:
             is_supported = False
         else:
             is_supported = debian_version >= self.minimum_version
 
         finally:
-            container.remove(force=True)
+            api.remove_container(container_id, force=True)
 
         return is_supported
 
     def generate_report(self):
         """Generate the report."""
-        self._cmd("Report generation", self._docker_cmd())
+        report = self._cmd("Report generation", self._docker_cmd())
+        try:
+            with open(self.filename, "wb") as fh:
+                fh.write(report)
+        except OSError as e:
+            logger.error("Could not save the report to %s: %s", self.filename, e)
+            raise DockerReportError("Report generation")
 
     def submit_report(self):
         """Submit the report"""
@@ -183,7 +254,9 @@ def main(args=None):
     exitcode = 0
     options = parse_args(args)
     setup_logging(logger, options)
-    report = DockerReport(options.image_name, options.report_dir, options.minimum_debian_version)
+    report = DockerReport(
+        options.image_name, options.report_dir, options.minimum_debian_version, force_pull=options.force_pull
+    )
     if not report.is_supported_image():
         logger.warning("Unable to create a report for %s. The image is not supported.", options.image_name)
         sys.exit(exitcode)
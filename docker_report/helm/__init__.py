@@ -15,8 +15,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
 import shutil
-import yaml
 import logging
 import subprocess
 import tempfile
@@ -36,9 +36,21 @@ class ChartError(Exception):
 
 def get_chart_name_version(chart_yaml: Path) -> Tuple[str, str]:
     """Return the version of the chart in chart_path"""
+    # Changes to the file are detected via its modification time and size.
+    st = chart_yaml.stat()
+    return _chart_name_version(chart_yaml, st.st_mtime_ns, st.st_size)
+
+
+@functools.lru_cache(maxsize=4096)
+def _chart_name_version(chart_yaml: Path, mtime_ns: int, size: int) -> Tuple[str, str]:
+    """Parse name and version from chart_yaml, cached by modification time and size of the file"""
+    import yaml
+
+    # Use the libyaml-based loader when available, it's much faster than the pure-python one.
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
     try:
         with chart_yaml.open() as f:
-            chart = yaml.safe_load(f)
+            chart = yaml.load(f, Loader=loader)
         return chart["name"], chart["version"]
     except (TypeError, KeyError) as e:
         logger.exception("Error parsing Chart.yaml: %s", e)
@@ -47,10 +59,11 @@ def get_chart_name_version(chart_yaml: Path) -> Tuple[str, str]:
 
 def package_chart(chart_path: Path) -> Path:
     """Package the chart in chart_path, return the path to chart tgz"""
-    output_dir = Path(tempfile.mkdtemp())
-    cmd = ["helm3", "package", "--destination", str(output_dir.absolute()), str(chart_path.absolute())]
+    output_dir = Path(tempfile.mkdtemp()).absolute()
+    chart_abspath = chart_path.absolute()
+    cmd = ["helm3", "package", "--destination", str(output_dir), str(chart_abspath)]
     try:
-        logger.info("Running helm package for: %s", chart_path.absolute())
+        logger.info("Running helm package for: %s", chart_abspath)
         out = subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode("utf-8").strip()
         logger.debug(out)
     except subprocess.CalledProcessError as e:
@@ -58,13 +71,13 @@ def package_chart(chart_path: Path) -> Path:
         logger.error(e.stdout.decode("utf-8"))
         raise HelmError(chart_path)
 
-    # Helm returns the generated file on success, parse it from the output
-    # black will add a whitespace before ':', so it's impossinble to pass flake8 and black here
-    output_file = Path(out[out.find(str(output_dir.absolute())) :])  # noqa: E203
+    # Helm returns the generated file on success, at the end of its output:
+    # "Successfully packaged chart and saved it to: <path>"
+    output_file = Path(out.rsplit(": ", 1)[-1])
     if not output_file.is_file():
         logger.error("No output file generated. Helm output was:")
         logger.error(out)
-        shutil.rmtree(output_dir.absolute())
+        shutil.rmtree(output_dir)
         raise HelmError(chart_path)
 
     return output_file
@@ -15,11 +15,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from __future__ import annotations
+
 import logging
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
 
-import requests
+if TYPE_CHECKING:
+    import requests
 
 logger = logging.getLogger(__name__)
 
@@ -39,23 +42,36 @@ class Chartmuseum:
         logger: logging.Logger = logger,
     ):
         self.chartmuseum_url = chartmuseum_url
+        self._api_base = chartmuseum_url.rstrip("/") + "/api/"
         self.username = username
         self.password = password
         self.logger = logger
+        # requests is imported lazily to keep the startup time of the CLI low.
+        from wmflib.requests import http_session
+
+        # Reuse the same session (and its connection pool) for all requests, so that
+        # we don't pay for a new TLS handshake for every chart.
+        self._session = http_session("chartmuseum", tries=3, backoff=0.2, timeout=600)
+
+    def close(self):
+        """Close the connections to the chartmuseum."""
+        self._session.close()
 
     def _request(self, url_part: str, method: str = "GET", **kwargs) -> requests.Response:
-        url = "/".join((self.chartmuseum_url.rstrip("/"), "api", url_part))
+        url = self._api_base + url_part
 
         if self.username and self.password:
             auth = (self.username, self.password)
             kwargs["auth"] = auth
 
-        response = requests.request(method, url, **kwargs)
+        response = self._session.request(method, url, **kwargs)
         response.raise_for_status()
         return response
 
     def get_charts(self, repository: str) -> Dict[str, List[Dict]]:
         """Fetch all charts and versions (index) for repository."""
+        import requests
+
         url_part = "/".join((repository, "charts"))
         try:
             return self._request(url_part).json()
@@ -65,6 +81,8 @@ class Chartmuseum:
 
     def get_chart_versions(self, repository: str, chart_name: str) -> List[Dict]:
         """Fetch all versions of a specific chart"""
+        import requests
+
         url_part = "/".join((repository, "charts", chart_name))
         try:
             return self._request(url_part).json()
@@ -74,6 +92,8 @@ class Chartmuseum:
 
     def upload_chart(self, repository, tgz_path: Path) -> requests.Response:
         """Upload chart tgz to the given repository."""
+        import requests
+
         url_part = "/".join((repository, "charts"))
 
         with tgz_path.open("rb") as chart_tgz:
@@ -97,3 +117,8 @@ class Chartmuseum:
             if cv.get("version") == version:
                 return True
         return False
+
+    @staticmethod
+    def index_repo(repo: Dict[str, List[Dict]]) -> Set[Tuple[str, str]]:
+        """Returns the set of all (name, version) pairs in the given repo, for fast lookups"""
+        return {(name, cv.get("version")) for name, cvs in repo.items() for cv in cvs}
@@ -15,19 +15,36 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from __future__ import annotations
+
+import fnmatch
+import functools
+import itertools
 import json
 import logging
 import os
 
 # Parts of the code below are taken from https://github.com/thcipriani/dockerregistry/
 import re
-from typing import Dict, List, Optional
-
-import requests
-
-from wmflib.requests import http_session
-
-REGISTRY_PAGINATION_RE = re.compile(r"<([^>]*)>")
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional
+
+if TYPE_CHECKING:
+    import requests
+
+try:
+    # orjson is considerably faster at decoding the large catalog and tag listings.
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Matches the url of the next page in the Link header of paginated responses.
+REGISTRY_PAGINATION_RE = re.compile(r'<([^>]*)>\s*;\s*rel="?next"?')
+# Matches "naked" tags, that are just the sha1 of a commit.
+NAKED_TAG_RE = re.compile(r"[a-zA-Z0-9]{40}")
+# Characters with a special meaning in globs.
+GLOB_META_RE = re.compile(r"[*?[]")
+MANIFEST_V1 = "application/vnd.docker.distribution.manifest.v1+json"
+MANIFEST_V2 = "application/vnd.docker.distribution.manifest.v2+json"
 
 logger = logging.getLogger(__name__)
 
@@ -36,10 +53,69 @@ def requests_session(retries: int = 3, backoff: int = 10) -> requests.sessions.S
     """
     Returns a requests session with the designated retry strategy
     """
+    # Imported here as requests and wmflib are slow to import, and not needed by all the commands.
+    from wmflib.requests import http_session
+
     # Use a 10 minute timeout by default.
     return http_session(name="registry", tries=retries, backoff=float(backoff), timeout=600)
 
 
+def is_naked_tag(tag: str) -> bool:
+    """Tell if a tag is "naked", i.e. just the sha1 of a commit."""
+    # Most tags are not 40 characters long, no need to run the regex on them.
+    return len(tag) == 40 and NAKED_TAG_RE.fullmatch(tag) is not None
+
+
+def glob_matcher(pattern: str) -> Callable[[str], bool]:
+    """Return a function telling if a string matches the given glob.
+
+    Globs that are just a literal with a leading and/or trailing * are checked with plain string
+    operations. The others are translated to a regex only once, while fnmatch.fnmatch() would look it
+    up again at every call.
+    """
+    start = pattern.startswith("*")
+    end = pattern.endswith("*")
+    literal = pattern[1:] if start else pattern
+    literal = literal[:-1] if end else literal
+    if not GLOB_META_RE.search(literal):
+        if start and end:
+            return lambda value: literal in value
+        elif start:
+            return lambda value: value.endswith(literal)
+        elif end:
+            return lambda value: value.startswith(literal)
+        return lambda value: value == literal
+
+    regex = re.compile(fnmatch.translate(pattern))
+
+    def match(value: str) -> bool:
+        return regex.match(value) is not None
+
+    return match
+
+
+@functools.lru_cache(maxsize=4)
+def _load_docker_config(filename: str, mtime_ns: Optional[int]) -> Dict:
+    """Load the authentication section of a docker config file.
+
+    The modification time is only part of the cache key, so that the file is parsed again if it changes.
+    Failures are cached as an empty dict too.
+    """
+    try:
+        with open(filename, "r") as fh:
+            return json.load(fh)["auths"]
+    except (KeyError, TypeError):
+        # The config has no authentication data.
+        pass
+    except (FileNotFoundError, PermissionError):
+        # No config file present, or it's not readable, we move on
+        pass
+    except json.decoder.JSONDecodeError:
+        # Config file is malformed. log it and move on
+        logger.warning("Could not read the settings file.")
+    return {}
+
+
 class RegistryError(Exception):
     """Generic error from interactions with the registry."""
 
@@ -52,59 +128,70 @@ class Registry:
     ):
         self.registry_url = registry
         self.logger = logger
-        self.auth = self._get_auth_token(configfile)
+        self._auth = self._get_auth_token(configfile)
         self.protocol = protocol
+        # The headers only depend on the manifest version we accept, so build them once.
+        self._headers = {}  # type: Dict[bool, Dict[str, str]]
+        for use_v2, accept in ((False, MANIFEST_V1), (True, MANIFEST_V2)):
+            self._headers[use_v2] = {"Accept": accept}
+            if self._auth is not None:
+                self._headers[use_v2]["Authorization"] = "Basic {}".format(self._auth)
+        # Reuse connections across requests, and keep the retry logic of the session.
+        self._session = requests_session()
+
+    @property
+    def auth(self) -> Optional[str]:
+        """The auth token for the registry, read-only as it's baked into the request headers."""
+        return self._auth
+
+    def close(self):
+        """Close the connections to the registry."""
+        self._session.close()
 
     def _get_auth_token(self, filename: Optional[str] = None) -> Optional[str]:
         if filename is None:
             filename = os.path.expanduser("~/.docker/config.json")
         try:
-            with open(filename, "r") as fh:
-                config = json.load(fh)
-            auths = config["auths"]
+            mtime_ns = os.stat(filename).st_mtime_ns  # type: Optional[int]
+        except OSError:
+            # Let the loader deal with (and cache) the missing file.
+            mtime_ns = None
+        auths = _load_docker_config(filename, mtime_ns)
+        try:
             for reg in [self.registry_url, "https://{}".format(self.registry_url)]:
                 if reg in auths:
                     return auths[reg]["auth"]
         except (KeyError, TypeError):
             # The config has nothing about our registry.
             pass
-        except (FileNotFoundError, PermissionError):
-            # No config file present, or it's not readable, we move on
-            pass
-        except json.decoder.JSONDecodeError:
-            # Config file is malformed. log it and move on
-            self.logger.warning("Could not read the settings file.")
         return None
 
     def _request(self, url_part: str, method: str = "GET", use_v2: bool = False) -> requests.Response:
         """Perform a request to the registry"""
-        headers = {}
-        if self.auth is not None:
-            headers["Authorization"] = "Basic {}".format(self.auth)
-        if use_v2:
-            headers["Accept"] = "application/vnd.docker.distribution.manifest.v2+json"
-        else:
-            headers["Accept"] = "application/vnd.docker.distribution.manifest.v1+json"
         url = "{}://{}{}".format(self.protocol, self.registry_url, url_part)
         # We experience sporadic 504 responses from the registry, in those cases, retry
         # with an exponential backoff
-        response = requests_session().request(method, url, headers=headers)
+        response = self._session.request(method, url, headers=self._headers[use_v2])
         response.raise_for_status()
         return response
 
-    def _get_all_pages(self, url_part: str) -> List[Dict]:
-        """Get all pages relative to a query."""
-        responses = []
+    def _iter_pages(self, url_part: str) -> Iterator[Dict]:
+        """Iterate over all pages relative to a query, fetching them as they're consumed."""
+        import requests
+
         try:
             while True:
                 # If this fails, an exception is raised.
                 self.logger.debug("Fetching: %s", url_part)
                 resp = self._request(url_part)
-                responses.append(resp.json())
-                if "next" not in resp.links:
-                    return responses
+                yield json_loads(resp.content)
+                # Parse the Link header directly, resp.links would parse all of its links on each access.
+                link = resp.headers.get("Link")
+                match = REGISTRY_PAGINATION_RE.search(link) if link else None
+                if match is None:
+                    return
                 # now let's inject the pagination in the query
-                url_part = resp.links["next"]["url"]
+                url_part = match.group(1)
         except requests.exceptions.HTTPError as e:
             # Workaround for https://github.com/docker/distribution/issues/2747
             # When using a swift backend, we get a 404 response if no tags are present
@@ -113,19 +200,27 @@ class Registry:
                     "Got a 404 not found for %s: possibly a case of https://github.com/docker/distribution/issues/2747",
                     url_part,
                 )
-                return responses
+                return
             else:
                 self.logger.exception("Error getting data from the registry")
                 raise RegistryError(url_part)
-        except requests.RequestException:
+        except (requests.RequestException, json.JSONDecodeError):
             self.logger.exception("Error getting data from the registry")
             raise RegistryError(url_part)
 
-    def get_tags_for_image(self, image_name: str) -> List[str]:
-        """Given an image name, get the corresponding tags"""
+    def _get_all_pages(self, url_part: str) -> List[Dict]:
+        """Get all pages relative to a query."""
+        return list(self._iter_pages(url_part))
+
+    def iter_tags_for_image(self, image_name: str) -> Iterator[str]:
+        """Given an image name, iterate over the corresponding tags.
+
+        Each page of tags is fetched only once the previous one has been consumed.
+        """
         self.logger.info("Fetching tags for %s", image_name)
-        tags = []  # type: List[str]
         url = "/v2/{}/tags/list".format(image_name)
-        for resp in self._get_all_pages(url):
-            tags.extend(resp.get("tags", []))
-        return tags
+        return itertools.chain.from_iterable(resp.get("tags", []) for resp in self._iter_pages(url))
+
+    def get_tags_for_image(self, image_name: str) -> List[str]:
+        """Given an image name, get the corresponding tags"""
+        return list(self.iter_tags_for_image(image_name))
@@ -16,12 +16,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # Parts of the code below are taken from https://github.com/thcipriani/dockerregistry/
 
+import collections
+import functools
+import itertools
 import json
 
+from concurrent.futures import Executor, Future, ThreadPoolExecutor  # noqa: F401
 from datetime import datetime
-from typing import Callable, Dict, List, Tuple
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple  # noqa: F401
 
-from docker_report.registry import Registry, RegistryError
+from docker_report.registry import Registry, RegistryError, json_loads
 
 # Functions that can act as a filter should accept the image name without tag as an input,
 # and return True if the image is admissible.
@@ -29,6 +33,22 @@ ImageFilter = Callable[[str], bool]
 # For tags, they should accept the image name and tag as arguments, in a tuple.
 TagFilter = Callable[[Tuple[str, str]], bool]
 
+# Maximum number of concurrent requests to the registry. Matches the size of the connection
+# pool of the requests session, so that all connections can be reused.
+MAX_WORKERS = 10
+# Maximum number of tag lists being fetched ahead of the image being worked on. It leaves the other
+# workers free for the requests about that image, e.g. fetching the creation dates of its tags.
+TAGS_PREFETCH = MAX_WORKERS // 2
+
+
+def _combine_filters(filters: List[Callable]) -> Callable[..., bool]:
+    """Combine a list of filters in a single function that returns True only if all of them do."""
+    if not filters:
+        return lambda _: True
+    if len(filters) == 1:
+        return filters[0]
+    return functools.reduce(lambda f, g: lambda x: f(x) and g(x), filters)
+
 
 class RegistryBrowserError(RegistryError):
     """Specific exception for the registry browser."""
@@ -37,59 +57,128 @@ class RegistryBrowserError(RegistryError):
 class RegistryBrowser(Registry):
     """Allows to browse the catalog of a standard docker registry"""
 
-    # Filters on the image names.
-    name_filters = []  # type: List[ImageFilter]
-    # Filters on image full names.
-    tag_filters = []  # type: List[TagFilter]
+    def __init__(
+        self,
+        *args,
+        name_filters: Optional[List[ImageFilter]] = None,
+        tag_filters: Optional[List[TagFilter]] = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        # Filters on the image names.
+        self.name_filters = list(name_filters or [])  # type: List[ImageFilter]
+        # Filters on image full names.
+        self.tag_filters = list(tag_filters or [])  # type: List[TagFilter]
+        # Creation dates of the tags already fetched, by (image, tag).
+        self._tag_dates = {}  # type: Dict[Tuple[str, str], datetime]
 
     def _get_images_list(self) -> List[str]:
         """Gets a list of images, filtered via a list of functions."""
         self.logger.info("Fetching the image catalog for %s", self.registry_url)
         images = []
+        name_filter = _combine_filters(self.name_filters)
 
-        for resp in self._get_all_pages("/v2/_catalog"):
+        for resp in self._iter_pages("/v2/_catalog"):
             images_in_resp = resp.get("repositories", [])
             # Only select images that pass all the filters
-            selected_images = [img for img in images_in_resp if all(fn(img) for fn in self.name_filters)]
+            selected_images = [img for img in images_in_resp if name_filter(img)]
             self.logger.debug("selected %d out of %d images", len(selected_images), len(images_in_resp))
             images.extend(selected_images)
 
         return images
 
+    def _iter_filtered_tags(self) -> Iterator[Tuple[str, List[str], Executor]]:
+        """Iterate over the images and their filtered tags, along with the executor to use for further requests."""
+        images = iter(self._get_images_list())
+        tag_filter = _combine_filters(self.tag_filters)
+        # Fetching the tags is bound by network latency, so do it in parallel.
+        # The same pool is used for other requests about the images, to keep the number
+        # of concurrent requests within the size of the connection pool.
+        executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        pending = collections.deque()  # type: Deque[Tuple[str, Future]]
+        try:
+            for image_name in itertools.islice(images, TAGS_PREFETCH):
+                pending.append((image_name, executor.submit(self.get_tags_for_image, image_name)))
+            while pending:
+                # The images are yielded in order, fetching the tags of the next one as each is taken.
+                image_name, future = pending.popleft()
+                for next_image in itertools.islice(images, 1):
+                    pending.append((next_image, executor.submit(self.get_tags_for_image, next_image)))
+                image_tags = future.result()
+                # Only select tags that pass all the filters
+                yield image_name, [tag for tag in image_tags if tag_filter((image_name, tag))], executor
+        finally:
+            # If the caller stops early, or a fetch fails, don't wait for the fetches nobody will use.
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def iter_image_tags(self, sort=False) -> Iterator[Tuple[str, List[str]]]:
+        """Iterate over the image data, as (image_name, tags) tuples.
+
+        Each image is yielded as soon as its tags are ready, so that callers can start working on it
+        while the tags of the following images are still being fetched.
+        """
+        for image_name, tags, executor in self._iter_filtered_tags():
+            if sort:
+                tags = self.sort_tags(image_name, tags, executor=executor)
+            if tags:
+                yield image_name, tags
+
+    def get_image_max_tag(self) -> Iterator[Tuple[str, str]]:
+        """Iterate over the images and their newest tag, as (image_name, tag) tuples."""
+        for image_name, tags, executor in self._iter_filtered_tags():
+            if tags:
+                yield image_name, self.newest_tag(image_name, tags, executor=executor)
+
     def get_image_tags(self, sort=False) -> Dict[str, List[str]]:
         """Get a dict of image data in the form image_name: tags."""
-        image_data = {}
-        for image_name in self._get_images_list():
-            # Only select tags that pass all the filters
-            tags = [
-                tag
-                for tag in self.get_tags_for_image(image_name)
-                if all(fn((image_name, tag)) for fn in self.tag_filters)
+        return dict(self.iter_image_tags(sort=sort))
+
+    def _fetch_tag_date(self, image: str, tag: str) -> datetime:
+        """Get the creation date of an image tag."""
+        try:
+            data = self._get_all_pages("/v2/{}/manifests/{}?cache=busted".format(image, tag))[0]["history"][0][
+                "v1Compatibility"
             ]
-            if sort:
-                tags = self.sort_tags(image_name, tags)
-            if tags:
-                image_data[image_name] = tags
+            date_str, _ = json_loads(data)["created"].split(".")
+            return datetime.fromisoformat(date_str)
+        except (KeyError, IndexError, TypeError, json.JSONDecodeError):
+            # We're going to ignore this later if we want
+            self.logger.exception("Malformed response for %s:%s", image, tag)
+            raise RegistryBrowserError("Could not sort {}".format(image))
 
-        return image_data
+    def _fetch_tag_dates(self, image: str, tags: List[str], executor: Optional[Executor] = None):
+        """Fetch the creation dates of the tags that are not known yet.
 
-    def sort_tags(self, image: str, tags: List[str]) -> List[str]:
+        The manifests are fetched using the given executor, or a new thread pool if none is passed.
+        """
+        to_fetch = [tag for tag in tags if (image, tag) not in self._tag_dates]
+        # Fetching the manifests is bound by network latency, so do it in parallel.
+        if executor is None:
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+                futures = {tag: pool.submit(self._fetch_tag_date, image, tag) for tag in to_fetch}
+        else:
+            futures = {tag: executor.submit(self._fetch_tag_date, image, tag) for tag in to_fetch}
+        # result() waits for each fetch, and raises the error of a failed one, if any.
+        for tag, future in futures.items():
+            self._tag_dates[(image, tag)] = future.result()
+
+    def sort_tags(self, image: str, tags: List[str], executor: Optional[Executor] = None) -> List[str]:
         """
         Given a list of tags for an image, sort them from the oldest to
         the newest.
         """
+        if len(tags) <= 1:
+            return list(tags)
+        self._fetch_tag_dates(image, tags, executor)
+        return sorted(tags, key=lambda tag: self._tag_dates[(image, tag)])
+
+    def newest_tag(self, image: str, tags: List[str], executor: Optional[Executor] = None) -> str:
+        """Given a non-empty list of tags for an image, return the newest one.
 
-        def get_tag_date(tag):
-            try:
-                data = self._get_all_pages("/v2/{}/manifests/{}?cache=busted".format(image, tag))[0]["history"][0][
-                    "v1Compatibility"
-                ]
-                date_str, _ = json.loads(data)["created"].split(".")
-                # TODO: fromisoformat
-                return datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S")
-            except (KeyError, IndexError, TypeError, json.JSONDecodeError):
-                # We're going to ignore this later if we want
-                self.logger.exception("Malformed response for %s:%s", image, tag)
-                raise RegistryBrowserError("Could not sort {}".format(image))
-
-        return sorted(tags, key=get_tag_date)
+        This is the last tag sort_tags would return, without sorting the whole list.
+        """
+        if len(tags) == 1:
+            return tags[0]
+        self._fetch_tag_dates(image, tags, executor)
+        # With equal dates, sort_tags keeps the original order, so prefer the last tag as it would.
+        return max(reversed(tags), key=lambda tag: self._tag_dates[(image, tag)])
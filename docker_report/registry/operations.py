@@ -14,12 +14,13 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-import fnmatch
-from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 
-import requests
+from docker_report.registry import GLOB_META_RE, Registry, glob_matcher
 
-from docker_report.registry import Registry
+# Maximum number of tags deleted concurrently, kept low to avoid overloading the write path of the registry.
+MAX_DELETE_WORKERS = 8
 
 
 class RegistryOperations(Registry):
@@ -27,29 +28,55 @@ class RegistryOperations(Registry):
 
     def _image_digest(self, name: str, tag: str) -> str:
         """Given an image name and tag, it returns the sha256 digest"""
-        resp = self._request("/v2/{}/manifests/{}".format(name, tag), use_v2=True)
+        # We only need the headers, so don't transfer the manifest itself.
+        resp = self._request("/v2/{}/manifests/{}".format(name, tag), method="HEAD", use_v2=True)
         return resp.headers.get("Docker-Content-Digest", "")
 
-    def delete_image(self, name: str, tag_glob: str) -> Tuple[List[str], List[str], List[str]]:
+    def delete_image(
+        self,
+        name: str,
+        tag_glob: str,
+        preselected_tags: Optional[List[str]] = None,
+        concurrency: int = MAX_DELETE_WORKERS,
+    ) -> Tuple[List[str], List[str], List[str]]:
         """Delete a specific tag (or tag glob) from an image.
 
-        Two lists are returned, in a tuple: the list of all processed tags, and the list of tags
-        that we failed to remove.
+        If the tags matching the glob have already been fetched, they can be passed as preselected_tags
+        to avoid fetching them again. A tag_glob without glob characters is deleted directly, without
+        listing the tags of the image. Up to concurrency tags are deleted at the same time.
+
+        Three lists are returned, in a tuple: the list of all processed tags, the list of tags
+        that we failed to remove, and the list of tags that were not found.
         """
-        failed = []
-        not_found = []
-        # let's find all the tags corresponding to the glob
-        tags = self.get_tags_for_image(name)
-        selected_tags = fnmatch.filter(tags, tag_glob)
-        for tag in selected_tags:
-            try:
-                digest = self._image_digest(name, tag)
-                delete_url = "/v2/{}/manifests/{}".format(name, digest)
-                self._request(delete_url, method="DELETE", use_v2=True)
-            except requests.RequestException as e:
-                if e.response is not None and e.response.status_code == 404:
-                    not_found.append(tag)
-                else:
-                    self.logger.exception("Error deleting the image %s:%s from the registry", name, tag)
-                    failed.append(tag)
+        if preselected_tags is None and not GLOB_META_RE.search(tag_glob):
+            # A single tag, there's no need to list all the tags of the image to find it.
+            selected_tags = [tag_glob]
+        elif preselected_tags is None:
+            # let's find all the tags corresponding to the glob
+            match = glob_matcher(tag_glob)
+            selected_tags = [tag for tag in self.iter_tags_for_image(name) if match(tag)]
+        else:
+            selected_tags = preselected_tags
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(lambda tag: self._delete_one(name, tag), selected_tags))
+        failed = [tag for tag, result in zip(selected_tags, results) if result == "failed"]
+        not_found = [tag for tag, result in zip(selected_tags, results) if result == "not_found"]
         return (selected_tags, failed, not_found)
+
+    def _delete_one(self, name: str, tag: str) -> str:
+        """Delete a single tag of an image.
+
+        Returns "ok" on success, "not_found" if the tag doesn't exist and "failed" otherwise.
+        """
+        import requests
+
+        try:
+            digest = self._image_digest(name, tag)
+            delete_url = "/v2/{}/manifests/{}".format(name, digest)
+            self._request(delete_url, method="DELETE", use_v2=True)
+        except requests.RequestException as e:
+            if e.response is not None and e.response.status_code == 404:
+                return "not_found"
+            self.logger.exception("Error deleting the image %s:%s from the registry", name, tag)
+            return "failed"
+        return "ok"
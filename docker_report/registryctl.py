@@ -24,21 +24,21 @@ This program allows to perform a series of actions on a registry:
 * Delete a specific version of an image.
 """
 import argparse
-import fnmatch
+import functools
 import logging
-import re
 import sys
 from typing import List, Optional, Tuple
 from urllib.parse import urlparse
 
 from docker_report import CustomFormatter, setup_logging
-from docker_report.registry import RegistryError, browser, operations
+from docker_report.registry import GLOB_META_RE, RegistryError, browser, glob_matcher, is_naked_tag, operations
 
 logger = logging.getLogger("docker-registryctl")
 
 
-def parse_args(args: Optional[List] = None) -> argparse.Namespace:
-    """Parse arguments."""
+@functools.lru_cache(maxsize=None)
+def _parser() -> argparse.ArgumentParser:
+    """Build the argument parser, only once."""
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=CustomFormatter)
     actions = parser.add_subparsers(dest="action", help="The action to perform")
     list_images = actions.add_parser("list-images")
@@ -64,7 +64,12 @@ def parse_args(args: Optional[List] = None) -> argparse.Namespace:
     log = parser.add_mutually_exclusive_group()
     log.add_argument("--debug", "-d", action="store_true", default=False, help="enable debugging")
     log.add_argument("--silent", "-s", action="store_true", default=False, help="don't log to console")
-    options = parser.parse_args(args)
+    return parser
+
+
+def parse_args(args: Optional[List] = None) -> argparse.Namespace:
+    """Parse arguments."""
+    options = _parser().parse_args(args)
     # Separate registry, image name and tag glob
     if options.action in ["list-tags", "delete-tags"]:
         url = "https://{}".format(options.image)
@@ -79,22 +84,15 @@ def parse_args(args: Optional[List] = None) -> argparse.Namespace:
     return options
 
 
-SHA1REGEX = re.compile(r"^[a-zA-Z0-9]{40}$")
-
-
 def exclude_naked(img_tag: Tuple[str, str]) -> bool:
-    return not SHA1REGEX.search(img_tag[1])
+    return not is_naked_tag(img_tag[1])
 
 
 def list_images(registry: str, filterglob: str):
     """Implementation of the list-images action"""
-    rb = browser.RegistryBrowser(registry, logger=logger)
-
-    def filter_glob(name):
-        return fnmatch.fnmatch(name, filterglob)
-
-    rb.name_filters.append(filter_glob)
-    rb.tag_filters.append(exclude_naked)
+    rb = browser.RegistryBrowser(
+        registry, logger=logger, name_filters=[glob_matcher(filterglob)], tag_filters=[exclude_naked]
+    )
 
     # We're trying to avoid using pyyaml here. Maybe not worth it?
     print("-- ")
@@ -109,15 +107,19 @@ def list_tags(registry_name: str, name: str, filterglob: str):
     registry = operations.RegistryOperations(registry_name, logger=logger)
     print("-- ")
     print("{}:".format(name))
-    for tag in fnmatch.filter(registry.get_tags_for_image(name), filterglob):
-        if exclude_naked(("", tag)):
+    match = glob_matcher(filterglob)
+    for tag in registry.iter_tags_for_image(name):
+        if match(tag) and exclude_naked(("", tag)):
             print("  - {}".format(tag))
 
 
 def delete_tags(registry_name: str, name: str, filterglob: str, force: bool = False):
     registry = operations.RegistryOperations(registry_name, logger=logger)
-    if not force:
-        to_remove = fnmatch.filter(registry.get_tags_for_image(name), filterglob)
+    to_remove = None  # type: Optional[List[str]]
+    # A single tag doesn't need a confirmation, and delete_image() doesn't need the list of tags to find it.
+    if not force and GLOB_META_RE.search(filterglob):
+        match = glob_matcher(filterglob)
+        to_remove = [tag for tag in registry.iter_tags_for_image(name) if match(tag)]
         if len(to_remove) > 1:
             print("We're about to delete the following tags for image {}/{}:".format(registry_name, name))
             for tag in to_remove:
@@ -126,12 +128,15 @@ def delete_tags(registry_name: str, name: str, filterglob: str, force: bool = Fa
             if resp.lower() != "y":
                 print("Aborting.")
                 return
-    selected, failed, not_found = registry.delete_image(name, filterglob)
+    # Pass along the tags we already selected, so they're not fetched and filtered again.
+    selected, failed, not_found = registry.delete_image(name, filterglob, preselected_tags=to_remove)
+    failed_set = set(failed)
+    not_found_set = set(not_found)
     for tag in selected:
         fullname = "{}/{}:{}".format(registry_name, name, tag)
-        if tag in failed:
+        if tag in failed_set:
             res = "FAIL"
-        elif tag in not_found:
+        elif tag in not_found_set:
             res = "GONE"
         else:
             res = "DONE"
@@ -58,6 +58,7 @@ Filter rules are in one of the following formats:
 """
 import argparse
 import configparser
+import functools
 import grp
 import logging
 import os
@@ -66,19 +67,22 @@ import shutil
 import stat
 import sys
 import tempfile
-from concurrent.futures import ThreadPoolExecutor
-from typing import Generator, List, Optional, Tuple
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ThreadPoolExecutor, as_completed, wait  # noqa: F401
+from typing import Callable, Generator, List, Optional, Set, Tuple  # noqa: F401
 
 from docker_report import CustomFormatter, setup_logging
 from docker_report.debmonitor import DockerReport, DockerReportError
-from docker_report.registry import RegistryError
+from docker_report.registry import RegistryError, is_naked_tag
 from docker_report.registry.browser import ImageFilter, RegistryBrowser, TagFilter
 
 logger = logging.getLogger("docker-report")
+# Characters with a special meaning in regexes.
+REGEX_META_RE = re.compile(r"[.^$*+?()[\]{}|\\]")
 
 
-def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
-    """Parse arguments."""
+@functools.lru_cache(maxsize=None)
+def _parser() -> argparse.ArgumentParser:
+    """Build the argument parser, only once."""
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=CustomFormatter)
     parser.add_argument(
         "registry", metavar="REGISTRY_NAME", help="The url (without scheme) of the docker registry to scan"
@@ -88,60 +92,105 @@ def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
     parser.add_argument("--exclude-tag-regexp", nargs="*", help="regexes for excluding tags")
     parser.add_argument("--filter-file", help="file containing filter rules")
     parser.add_argument("--keep", action="store_true", help="keep docker images after downloading them.")
+    parser.add_argument(
+        "--force-pull",
+        action="store_true",
+        help="pull images even if they're already present locally, to pick up re-pushed tags.",
+    )
     parser.add_argument("--concurrency", type=int, default=1, help="Maximum concurrency in running debmonitor reports.")
     parser.add_argument("--debmonitor-group", default="debmonitor", help="Name of the debmonitor POSIX group")
+    parser.add_argument(
+        "--tempdir-base", help="Directory where to create the temporary directory for the reports, e.g. a tmpfs."
+    )
     parser.add_argument(
         "--minimum-debian-version", default=10, help="Minimum Debian major version that is considered supported."
     )
     log = parser.add_mutually_exclusive_group()
     log.add_argument("--debug", "-d", action="store_true", default=False, help="enable debugging")
     log.add_argument("--silent", "-s", action="store_true", default=False, help="don't log to console")
-    return parser.parse_args(args)
+    return parser
+
+
+def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse arguments."""
+    return _parser().parse_args(args)
 
 
 def setup_browser(options: argparse.Namespace) -> RegistryBrowser:
     """Sets up the repo browser with all filters."""
-    br = RegistryBrowser(options.registry, logger=logger)
+    name_filters = []  # type: List[ImageFilter]
+    tag_filters = []  # type: List[TagFilter]
     if options.exclude_namespaces:
+        namespaces = tuple(options.exclude_namespaces)
 
         def exclude_namespaces(name):
-            for ns in options.exclude_namespaces:
-                if name.startswith(ns):
-                    return False
-            return True
+            # startswith checks all the prefixes in a single call.
+            return not name.startswith(namespaces)
 
-        br.name_filters.append(exclude_namespaces)
+        name_filters.append(exclude_namespaces)
 
-    if not options.no_exclude_naked:
-        sha1regex = re.compile(r"^[a-zA-Z0-9]{40}$")
+    # Naked tags and tags matching the user regexes are all excluded by a single filter.
+    exclude_naked = not options.no_exclude_naked
+    matches = _matches_any(options.exclude_tag_regexp) if options.exclude_tag_regexp else None
+    if exclude_naked or matches is not None:
 
-        def exclude_naked(data):
-            return not sha1regex.search(data[1])
+        def exclude_tags(data):
+            tag = data[1]
+            if exclude_naked and is_naked_tag(tag):
+                return False
+            return matches is None or not matches(tag)
 
-        br.tag_filters.append(exclude_naked)
+        tag_filters.append(exclude_tags)
 
-    if options.exclude_tag_regexp:
-        regexes = [re.compile(r) for r in options.exclude_tag_regexp]
+    if options.filter_file:
+        file_img_filters, file_tag_filters = _filters_from_file(options.filter_file)
+        name_filters.extend(file_img_filters)
+        tag_filters.extend(file_tag_filters)
+    return RegistryBrowser(options.registry, logger=logger, name_filters=name_filters, tag_filters=tag_filters)
+
+
+def _matches_any(patterns: List[str]) -> Callable[[str], bool]:
+    """Returns a function that tells if a string matches any of the regexes.
+
+    Where possible, the regexes are combined in a single alternation, so that they're all searched in one call.
+    """
+    # Compile each regex on its own first, so that an invalid one is reported as such.
+    regexes = [re.compile(p) for p in patterns]
+    if len(regexes) == 1:
+        regex = regexes[0]
+        return lambda x: regex.search(x) is not None
+    # Backreferences would refer to the wrong group once the regexes are combined, and inline global
+    # flags would apply to the whole combined regex (Python < 3.11) or make it invalid.
+    if all(r.groups == 0 and r.flags == re.UNICODE for r in regexes):
+        fused = re.compile("|".join("(?:{})".format(p) for p in patterns))
+        return lambda x: fused.search(x) is not None
+    return lambda x: any(r.search(x) for r in regexes)
 
-        def exclude_tag_regexp(data):
-            for r in regexes:
-                if r.search(data[1]):
-                    return False
-            return True
 
-        br.tag_filters.append(exclude_tag_regexp)
+def _filters_from_file(filename: str) -> Tuple[List[ImageFilter], List[TagFilter]]:
+    try:
+        mtime_ns = os.stat(filename).st_mtime_ns
+    except (OSError, ValueError):
+        # Not a file we can stat, nothing to cache.
+        return _parse_filters_file(filename)
+    image_filters, tag_filters = _cached_filters_file(filename, mtime_ns)
+    # Return copies, so that callers can't alter the cached lists.
+    return (list(image_filters), list(tag_filters))
+
 
-    if options.filter_file:
-        img_filters, tag_filters = _filters_from_file(options.filter_file)
-        br.name_filters.extend(img_filters)
-        br.tag_filters.extend(tag_filters)
-    return br
+@functools.lru_cache(maxsize=8)
+def _cached_filters_file(filename: str, mtime_ns: int) -> Tuple[List[ImageFilter], List[TagFilter]]:
+    """Parse a filter file, caching the result until the file is modified."""
+    return _parse_filters_file(filename)
 
 
-def _filters_from_file(filename: str) -> Tuple[List[ImageFilter], List[TagFilter]]:
+def _parse_filters_file(filename: str) -> Tuple[List[ImageFilter], List[TagFilter]]:
     logger.debug("Processing file %s", filename)
     image_filters = []
     tag_filters = []
+    # The rules excluding images by name, checked all at once by a single filter, and their regexes.
+    excluded_rules = []  # type: List[str]
+    excluded_names = []  # type: List[str]
     config = configparser.ConfigParser()
     config.read(filename)
     for name, rules in config.items():
@@ -150,12 +199,27 @@ def _filters_from_file(filename: str) -> Tuple[List[ImageFilter], List[TagFilter
             tag_rule = _tag(rules)
             if tag_rule is not None:
                 tag_filters.append(tag_rule)
+        elif "name" in rules and rules.get("action", "include") == "exclude":
+            try:
+                excluded_names.append(_rule_regex(rules["name"]))
+            except ValueError as e:
+                # Invalid rule - we ignore it
+                logger.warning(e)
+            else:
+                excluded_rules.append(rules["name"])
         elif "name" in rules:
             img_rule = _image(rules)
             if img_rule is not None:
                 image_filters.append(img_rule)
         else:
             logger.warning("Discarding rule %s - it contains no conditions", name)
+    if excluded_names:
+        if len(excluded_names) == 1:
+            # A single rule can often be checked with plain string operations.
+            matches = _parse_rule(excluded_rules[0])
+        else:
+            matches = _matches_any(excluded_names)
+        image_filters.append(lambda name: not matches(name))
     return (image_filters, tag_filters)
 
 
@@ -182,13 +246,15 @@ def _tag(rules: configparser.SectionProxy) -> Optional[TagFilter]:
         logger.warning("Error while evaluating tag rule - invalid tag: %s", e)
         return None
 
+    # The action doesn't change, no need to look it up at every call.
+    exclude = rules.get("action", "include") == "exclude"
+
     def _condition(data):
         # If the name condition doesn't match, we do not apply filtering logic
         if not name_cond(data[0]):
             return True
 
-        action = rules.get("action", "include")
-        if action == "exclude":
+        if exclude:
             return not tag_cond(data[1])
         else:
             return tag_cond(data[1])
@@ -196,17 +262,50 @@ def _tag(rules: configparser.SectionProxy) -> Optional[TagFilter]:
     return _condition
 
 
+def _literal_rule(pattern: str) -> Optional[ImageFilter]:
+    """Returns a plain string comparison equivalent to the regex, if it's just a literal (optionally anchored)."""
+    start = pattern.startswith("^")
+    end = pattern.endswith("$")
+    literal = pattern[1:] if start else pattern
+    literal = literal[:-1] if end else literal
+    if REGEX_META_RE.search(literal):
+        return None
+    if start and end:
+        return lambda x: x == literal
+    elif start:
+        return lambda x: x.startswith(literal)
+    elif end:
+        return lambda x: x.endswith(literal)
+    return lambda x: literal in x
+
+
+@functools.lru_cache(maxsize=256)
 def _parse_rule(rule: str) -> ImageFilter:
     if rule.startswith("regex:"):
-        regex = re.compile(rule[6:])
-        return lambda x: bool(regex.search(x))
+        literal = _literal_rule(rule[6:])
+        if literal is not None:
+            return literal
+        # Rules match anywhere in the string, so search is used rather than match; users can anchor them with ^.
+        search = re.compile(rule[6:]).search
+        return lambda x: search(x) is not None
     elif rule.startswith("contains:"):
-        return lambda x: (rule[9:] in x)
+        needle = rule[9:]
+        return lambda x: needle in x
     else:
         # Invalid rule. We ignore it in the callers
         raise ValueError("Unrecognized rule %s", rule)
 
 
+def _rule_regex(rule: str) -> str:
+    """Returns the regex equivalent to a rule."""
+    if rule.startswith("regex:"):
+        return rule[6:]
+    elif rule.startswith("contains:"):
+        return re.escape(rule[9:])
+    else:
+        raise ValueError("Unrecognized rule %s", rule)
+
+
 def _image(rules: configparser.SectionProxy) -> Optional[ImageFilter]:
     try:
         name_cond = _parse_rule(rules["name"])
@@ -220,9 +319,9 @@ def _image(rules: configparser.SectionProxy) -> Optional[ImageFilter]:
         return name_cond
 
 
-def _tempdir(group_name: str = "debmonitor") -> str:
+def _tempdir(group_name: str = "debmonitor", base_dir: Optional[str] = None) -> str:
     """Create a tempdir, make it writable to debmonitor."""
-    tempdir = tempfile.mkdtemp("-docker-report")
+    tempdir = tempfile.mkdtemp("-docker-report", dir=base_dir)
     group = grp.getgrnam(group_name).gr_gid
     os.chown(tempdir, os.getuid(), group)
     os.chmod(tempdir, stat.S_IRWXU | stat.S_IRWXG)
@@ -230,20 +329,24 @@ def _tempdir(group_name: str = "debmonitor") -> str:
 
 
 class Reporter:
-    def __init__(self, browser: RegistryBrowser, tempdir: str, keep_images: bool, minimum_major: int):
+    def __init__(
+        self, browser: RegistryBrowser, tempdir: str, keep_images: bool, minimum_major: int, force_pull: bool = False
+    ):
         self._browser = browser
+        self._registry_url = browser.registry_url
         self.exitcode = 0
         self._tempdir = tempdir
         self._prune_images = not keep_images
         self._failed = []  # type: List[str]
         self._success = []  # type: List[str]
         self._minimum_major = minimum_major
+        self._force_pull = force_pull
 
     def run_report(self, image: str):
         """Run the report on one image"""
         logger.info("Building debmonitor report for %s", image)
         try:
-            debmonitor = DockerReport(image, self._tempdir, self._minimum_major)
+            debmonitor = DockerReport(image, self._tempdir, self._minimum_major, force_pull=self._force_pull)
             if not debmonitor.is_supported_image():
                 logger.warning("Unable to create a report for %s. The image is not supported.", image)
                 return
@@ -258,47 +361,72 @@ class Reporter:
             logger.error("Debmonitor report for image %s failed", image)
             self.exitcode = 3
 
-    def _image_full_name(self, name: str, tag: str) -> str:
-        """Fully qualified name of the image"""
-        return "{}/{}:{}".format(self._browser.registry_url, name, tag)
-
     def get_images(self) -> Generator[str, None, None]:
         """Gets all the image names, as a generator."""
         try:
-            for name, tags in self._browser.get_image_tags(sort=True).items():
-                tag = tags[-1]
-                yield self._image_full_name(name, tag)
+            # Images are yielded while the following ones are still being listed, so that
+            # the reports can start running in the meantime.
+            for name, tag in self._browser.get_image_max_tag():
+                # Fully qualified name of the image
+                yield "{}/{}:{}".format(self._registry_url, name, tag)
         except RegistryError:
             self.exitcode = 2
 
     def pprint(self):
         """Pretty-prints results"""
+        lines = []
         if not self._failed:
-            print("All images submitted correctly!")
-        print("")
-        print("Detailer results:")
-        for img in self._success:
-            print("%-70s[OK]" % img)
-        for img in self._failed:
-            print("%-68s[FAIL]" % img)
+            lines.append("All images submitted correctly!")
+        lines.extend(["", "Detailer results:"])
+        lines.extend("%-70s[OK]" % img for img in self._success)
+        lines.extend("%-68s[FAIL]" % img for img in self._failed)
+        # Write all the results at once.
+        print("\n".join(lines))
+
+
+def _run_reports(executor: Executor, report: Reporter, max_pending: int):
+    """Run the reports of all images, with at most max_pending of them submitted and not completed.
+
+    Images are submitted as soon as they're listed, and completed reports are reaped in any order,
+    so that errors surface immediately.
+    """
+    pending = set()  # type: Set[Future]
+    for image in report.get_images():
+        pending.add(executor.submit(report.run_report, image))
+        if len(pending) >= max_pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+    for future in as_completed(pending):
+        future.result()
 
 
 def main(args=None):
     options = parse_args(args)
     setup_logging(logger, options)
+    tempdir = None  # type: Optional[str]
+    exitcode = 1
     try:
-        tempdir = _tempdir(options.debmonitor_group)
+        tempdir = _tempdir(options.debmonitor_group, options.tempdir_base)
         registry = setup_browser(options)
-        report = Reporter(registry, tempdir, options.keep, options.minimum_debian_version)
+        report = Reporter(
+            registry, tempdir, options.keep, options.minimum_debian_version, force_pull=options.force_pull
+        )
         with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
-            for _ in executor.map(report.run_report, report.get_images()):
-                # Do nothing here, just catch exceptions.
-                pass
+            try:
+                _run_reports(executor, report, options.concurrency * 2)
+            except Exception:
+                # Don't start working on the images still in the queue
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
         report.pprint()
+        exitcode = report.exitcode
     except Exception:
         logger.exception("Unexpected error during execution")
-        report.exitcode = 1
+        exitcode = 1
     finally:
-        shutil.rmtree(tempdir)
+        # The tempdir might not have been created, and failing to clean it up shouldn't hide the outcome.
+        if tempdir is not None:
+            shutil.rmtree(tempdir, ignore_errors=True)
 
-    sys.exit(report.exitcode)
+    sys.exit(exitcode)
@@ -24,6 +24,7 @@ def test_parse_args_walk():
     assert options.repository == "nowhere"
     assert options.path == Path("/tmp/foo")
     assert options.cm_url == "https://httpbin.org/foo"
+    assert options.concurrency == 8
 
 
 def test_parse_args_upload():
@@ -33,6 +34,12 @@ def test_parse_args_upload():
     assert options.path == Path("/tmp/foo/file.tgz")
 
 
+def test_parse_args_action_as_option_value():
+    options = chartctl.parse_args(["--cm-user", "push", "walk", "/tmp/foo", "nowhere"])
+    assert options.action == "walk"
+    assert options.cm_user == "push"
+
+
 def test_parse_args_unknown_action():
     with pytest.raises(SystemExit):
         chartctl.parse_args(["--silent", "noaction", "/tmp/foo/file.tgz", "nowhere"])
@@ -49,3 +56,40 @@ def test_parse_args_auth_environment():
     options = chartctl.parse_args(["push", "/tmp/foo", "nowhere"])
     assert options.cm_user == "hru"
     assert options.cm_password == "hrp"
+
+
+def test_find_chart_yamls(tmp_path):
+    for chart in ["foo", "bar", "bar/charts/baz", ".git/foo"]:
+        (tmp_path / chart).mkdir(parents=True)
+        (tmp_path / chart / "Chart.yaml").touch()
+    (tmp_path / "foo" / "values.yaml").touch()
+    found = set(chartctl._find_chart_yamls(tmp_path))
+    assert found == {tmp_path / "foo/Chart.yaml", tmp_path / "bar/Chart.yaml", tmp_path / "bar/charts/baz/Chart.yaml"}
+
+
+@mock.patch("docker_report.chartctl.push")
+@mock.patch("docker_report.chartctl.get_chart_name_version")
+def test_walk(chart_nv, push, tmp_path):
+    for chart in ["foo", "bar", "baz"]:
+        (tmp_path / chart).mkdir()
+        (tmp_path / chart / "Chart.yaml").touch()
+    chart_nv.side_effect = lambda chart_yaml: (chart_yaml.parent.name, "0.0.1")
+    cm = mock.MagicMock()
+    cm.index_repo.return_value = {("bar", "0.0.1"), ("foo", "0.0.0")}
+    chartctl.walk(cm, "stable", tmp_path)
+    cm.get_charts.assert_called_once_with("stable")
+    pushed = {c.args[2] for c in push.call_args_list}
+    assert pushed == {tmp_path / "foo", tmp_path / "baz"}
+
+
+@mock.patch("docker_report.chartctl.push")
+@mock.patch("docker_report.chartctl.get_chart_name_version")
+def test_walk_error(chart_nv, push, tmp_path):
+    (tmp_path / "foo").mkdir()
+    (tmp_path / "foo" / "Chart.yaml").touch()
+    chart_nv.return_value = ("foo", "0.0.1")
+    push.side_effect = chartctl.HelmError("foo")
+    cm = mock.MagicMock()
+    cm.index_repo.return_value = set()
+    with pytest.raises(chartctl.HelmError):
+        chartctl.walk(cm, "stable", tmp_path, concurrency=1)
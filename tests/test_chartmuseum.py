@@ -89,6 +89,18 @@ def test_init():
     assert c.password is None
 
 
+def test_url_trailing_slash(req_mock):
+    c = Chartmuseum("https://httpbin.org/")
+    with req_mock:
+        assert c.get_charts("bar") == {}
+
+
+def test_close(chartmuseum):
+    chartmuseum._session = mock.MagicMock()
+    chartmuseum.close()
+    chartmuseum._session.close.assert_called_once_with()
+
+
 def test_get_charts(chartmuseum, req_mock):
     with req_mock:
         assert chartmuseum.get_charts("bar") == {}
@@ -147,3 +159,9 @@ def test_is_version_in_repo(chartmuseum, req_mock):
         assert Chartmuseum.is_version_in_repo(repo, "blubberoid", "0.0.23") is True
         assert Chartmuseum.is_version_in_repo(repo, "blubberoid", "0.1.23") is False
         assert Chartmuseum.is_version_in_repo(repo, "nonexistent", "0.1.23") is False
+
+
+def test_index_repo(chartmuseum, req_mock):
+    with req_mock:
+        index = Chartmuseum.index_repo(chartmuseum.get_charts("foo"))
+    assert index == {("blubberoid", "0.0.26"), ("blubberoid", "0.0.23"), ("raw", "0.2.0-wmf1")}
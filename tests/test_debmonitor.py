@@ -2,6 +2,7 @@ import logging
 import subprocess
 import tarfile
 from io import BytesIO
+from types import SimpleNamespace
 from unittest import mock
 
 import docker.errors as docker_errors
@@ -10,38 +11,68 @@ import pytest
 from docker_report import debmonitor
 
 
-def test_args_valid():
+@pytest.fixture(scope="module")
+def debug_options():
+    """Parsed command line in debug mode, shared by the tests that don't modify it"""
+    return debmonitor.parse_args(["--debug", "image_name", "directory"])
+
+
+@pytest.fixture(scope="module")
+def default_options():
+    """Parsed command line with the default options"""
+    return debmonitor.parse_args(["image", "dir"])
+
+
+def test_args_valid(debug_options):
     """Test the happy path for parsing args"""
-    args = ["--debug", "image_name", "directory"]
-    options = debmonitor.parse_args(args)
-    assert options.debug
-    assert options.image_name == "image_name"
-    assert options.report_dir == "directory"
-    assert options.silent is False
-    assert options.no_submit is False
-    assert options.keep is False
+    assert debug_options.debug
+    assert debug_options.image_name == "image_name"
+    assert debug_options.report_dir == "directory"
+    assert debug_options.silent is False
+    assert debug_options.no_submit is False
+    assert debug_options.keep is False
 
 
-def test_setup_logging():
+def test_setup_logging(debug_options, default_options):
     """Test that logging gets set up"""
-    args = ["--debug", "image_name", "directory"]
-    options = debmonitor.parse_args(args)
-    debmonitor.setup_logging(debmonitor.logger, options)
+    debmonitor.setup_logging(debmonitor.logger, debug_options)
     assert debmonitor.logger.level == logging.DEBUG
-    options = debmonitor.parse_args(["image", "dir"])
-    debmonitor.setup_logging(debmonitor.logger, options)
+    # Records are written to the console as soon as they're emitted
+    assert type(debmonitor.logger.handlers[-1]) is logging.StreamHandler
+    debmonitor.setup_logging(debmonitor.logger, default_options)
     assert debmonitor.logger.level == logging.INFO
 
 
+def test_logger_hierarchy():
+    """Messages logged while running docker-report end up in its logger"""
+    parent = logging.getLogger("docker-report")
+    assert debmonitor.logger.parent is parent
+
+
+@pytest.fixture(scope="module", autouse=True)
+def from_env():
+    """Mock the docker client once for the whole module"""
+    with mock.patch("docker.from_env") as from_env:
+        yield from_env
+
+
+@pytest.fixture(autouse=True)
+def docker_client(from_env):
+    """Don't share the (mocked) docker client between tests"""
+    debmonitor._docker_client.cache_clear()
+    # Each test gets a new client mock, without any configuration left by the previous ones.
+    from_env.reset_mock(return_value=True, side_effect=True)
+    yield
+    debmonitor._docker_client.cache_clear()
+
+
 @pytest.fixture
 def report(
     name: str = "docker-registry.wikimedia.org/envoy-tls-local-proxy:1.12.2-1",
     report_dir: str = "/tmp",
     major: int = 10,
 ):
-    # Mock the docker client
-    with mock.patch("docker.from_env", mock.MagicMock()):
-        return debmonitor.DockerReport(name, report_dir, minimum_major=major)
+    return debmonitor.DockerReport(name, report_dir, minimum_major=major)
 
 
 def test_report_init(report):
@@ -50,15 +81,25 @@ def test_report_init(report):
     assert report.filename == "/tmp/docker-registry.wikimedia.org-envoy-tls-local-proxy:1.12.2-1.debmonitor.json"
 
 
-def test_generate_report(report):
+def test_generate_report(report, tmp_path):
     """Test report generation does the right thing."""
-    report._cmd = mock.MagicMock()
+    report.filename = str(tmp_path / report.file_basename)
+    report._cmd = mock.Mock(return_value=b'{"packages": []}')
     report.generate_report()
     report._cmd.assert_called_with("Report generation", report._docker_cmd())
+    # The output of the command is saved as the report
+    assert (tmp_path / report.file_basename).read_bytes() == b'{"packages": []}'
+
+
+def test_generate_report_write_error(report, tmp_path):
+    report.filename = str(tmp_path / "nonexistent" / report.file_basename)
+    report._cmd = mock.Mock(return_value=b"{}")
+    with pytest.raises(debmonitor.DockerReportError):
+        report.generate_report()
 
 
 def test_submit_report(report):
-    report._cmd = mock.MagicMock()
+    report._cmd = mock.Mock()
     report.submit_report()
     report._cmd.assert_called_with(
         "Submit report",
@@ -77,180 +118,221 @@ def test_docker_cmd(report):
     report.proxy = "pinkunicorn"
     res = report._docker_cmd()
     assert res[-1].startswith("echo 'Acquire::http::Proxy \"pinkunicorn\";'")
-    assert "/tmp:/mnt:rw" in res
+    assert "-v" not in res
     bash = res[-1].split(" && ")
-    assert (
-        "/usr/bin/debmonitor-client -n -i 'docker-registry.wikimedia.org/envoy-tls-local-proxy:1.12.2-1' > "
-        "'/mnt/docker-registry.wikimedia.org-envoy-tls-local-proxy:1.12.2-1.debmonitor.json'" in bash
-    )
+    # The report is written to stdout
+    assert bash[-1] == "/usr/bin/debmonitor-client -n -i 'docker-registry.wikimedia.org/envoy-tls-local-proxy:1.12.2-1'"
+    assert all(cmd.endswith(">&2") for cmd in bash[1:-1])
 
 
-@mock.patch("subprocess.check_output")
-def test_cmd_error(mocker, report):
+@mock.patch("subprocess.run")
+def test_cmd_error(mocker, report, caplog):
     """Test that errors in commands are correctly handled"""
     with pytest.raises(debmonitor.DockerReportError):
-        mocker.side_effect = subprocess.CalledProcessError(1, "foobar", b"nope")
+        mocker.side_effect = subprocess.CalledProcessError(1, "foobar", b"partial", b"nope")
         report._cmd("test", ["some", "command"])
+    messages = [r.getMessage() for r in caplog.records if r.levelno == logging.ERROR]
+    assert messages[-2:] == ["partial", "nope"]
 
 
-@mock.patch("subprocess.check_output")
-def test_cmd_ok(mocker, report):
+@mock.patch("subprocess.run")
+def test_cmd_ok(mocker, report, caplog):
     """Test that a normal command will report its results"""
-    debmonitor.logger.debug = mock.MagicMock()
-    mocker.return_value = b"success!"
-    report._cmd("test", ["cowsay", "pinkunicorn"])
-    debmonitor.logger.debug.assert_called_with("success!")
+    mocker.return_value.stdout = b"success!"
+    mocker.return_value.stderr = b"moo"
+    with caplog.at_level(logging.DEBUG, logger=debmonitor.logger.name):
+        assert report._cmd("test", ["cowsay", "pinkunicorn"]) == b"success!"
+    assert caplog.record_tuples[-1] == (debmonitor.logger.name, logging.DEBUG, "moo")
+    mocker.assert_called_with(["cowsay", "pinkunicorn"], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
 
 def test_prune_image(report):
-    report._cmd = mock.MagicMock()
+    report._cmd = mock.Mock()
     report.prune_image()
     report._cmd.assert_called_with(
         "Image pruning", ["docker", "rmi", "-f", "docker-registry.wikimedia.org/envoy-tls-local-proxy:1.12.2-1"]
     )
 
 
-def test_extract_debian_version(report):
-    container_mock = mock.MagicMock()
-    container_mock.get_archive = mock.MagicMock()
-
-    major = 9
-    minor = 13
+def _tar_bytes(name: str, data: bytes) -> bytes:
     memfile = BytesIO()
-    debian_version = f"{major}.{minor}\n".encode()
     with tarfile.open(fileobj=memfile, mode="w") as tar:
-        # Create a TarInfo object for the file
-        tarinfo = tarfile.TarInfo("debian_version")
-        tarinfo.size = len(debian_version)
-        # Add the file to the Tar archive
-        tar.addfile(tarinfo, BytesIO(debian_version))
-    stat = "{'name': 'debian_version', 'size': 5, 'mode': 420, 'mtime': '2020-07-10T23:05:00+02:00', 'linkTarget': ''}"
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.size = len(data)
+        tar.addfile(tarinfo, BytesIO(data))
+    return memfile.getvalue()
 
-    container_mock.get_archive.return_value = [(memfile.getvalue(),), stat]
-    report.client.containers.create.return_value = container_mock
-    assert report._extract_debian_version((memfile.getvalue(),)) == (9, 13)
 
+# Archives returned by get_archive for /etc/debian_version, by (major, minor) version.
+DEBIAN_VERSION_TARS = {
+    (major, minor): _tar_bytes("debian_version", "{}.{}\n".format(major, minor).encode())
+    for major, minor in [(9, 13), (12, 5)]
+}
 
-def test_is_supported_image_ok(report):
-    container_mock = mock.MagicMock()
-    container_mock.get_archive.return_value = ("", "")
-    report.client.containers.create.return_value = container_mock
-    report._extract_debian_version = mock.MagicMock()
-    report._extract_debian_version.return_value = (12, 42)
-    assert report.is_supported_image() is True
-    report.client.containers.create.assert_called_with(report.image, command="/false")
-    container_mock.get_archive.assert_called_with("/etc/debian_version")
-    container_mock.remove.assert_called_with(force=True)
 
+@pytest.mark.parametrize("version", DEBIAN_VERSION_TARS)
+def test_extract_debian_version(report, version):
+    assert report._extract_debian_version((DEBIAN_VERSION_TARS[version],)) == version
 
-def test_is_supported_image_error(report):
-    container_mock = mock.MagicMock()
-    report.client.containers.create.return_value = container_mock
-    container_mock.get_archive.side_effect = docker_errors.NotFound("whatever")
-    assert report.is_supported_image() is False
-    container_mock.remove.assert_called_with(force=True)
 
+def test_extract_debian_version_chunked(report):
+    """The archive is read correctly when split in many chunks"""
+    data = DEBIAN_VERSION_TARS[(12, 5)]
+    chunks = [data[i : i + 100] for i in range(0, len(data), 100)]  # noqa: E203
+    assert report._extract_debian_version(chunks) == (12, 5)
 
-def test_is_supported_image_pull_error(report):
-    debmonitor.logger.error = mock.MagicMock()
-    report.client.images.pull.side_effect = docker_errors.NotFound("whatever")
-    assert report.is_supported_image() is False
-    debmonitor.logger.error.assert_called_with(
-        "Failed to pull/create image %s: %s", report.image, report.client.images.pull.side_effect
-    )
+
+@pytest.mark.parametrize("stream", [(_tar_bytes("os-release", b"12.5\n"),), (b"",), (b"not a tar archive",)])
+def test_extract_debian_version_error(report, stream):
+    with pytest.raises(debmonitor.DockerReportError):
+        report._extract_debian_version(stream)
+
+
+def test_is_supported_image_ok(report):
+    api = report.client.api
+    api.create_container.return_value = {"Id": "abcd"}
+    api.get_archive.return_value = ("", "")
+    report._extract_debian_version = mock.Mock()
+    report._extract_debian_version.return_value = (12, 42)
+    assert report.is_supported_image() is True
+    # The image is present locally, so it's not pulled
+    api.inspect_image.assert_called_with(report.image)
+    assert api.pull.call_count == 0
+    api.create_container.assert_called_with(report.image, command="/false")
+    api.get_archive.assert_called_with("abcd", "/etc/debian_version")
+    api.remove_container.assert_called_with("abcd", force=True)
+
+
+@pytest.mark.parametrize("force_pull", [True, False])
+def test_is_supported_image_pull(report, force_pull):
+    """The image is pulled if it's not present locally, or if force_pull is set"""
+    api = report.client.api
+    report.force_pull = force_pull
+    if not force_pull:
+        api.inspect_image.side_effect = docker_errors.ImageNotFound("whatever")
+    api.create_container.return_value = {"Id": "abcd"}
+    api.get_archive.return_value = ("", "")
+    report._extract_debian_version = mock.Mock(return_value=(12, 42))
+    assert report.is_supported_image() is True
+    api.pull.assert_called_with(report.image, stream=True, decode=True)
 
 
-def test_is_supported_image_create_error(report):
-    debmonitor.logger.error = mock.MagicMock()
-    report.client.containers.create.side_effect = docker_errors.NotFound("whatever")
+def test_is_supported_image_pull_error(report, caplog):
+    """Errors reported in the output of the pull make the image unsupported"""
+    api = report.client.api
+    api.inspect_image.side_effect = docker_errors.ImageNotFound("whatever")
+    api.pull.return_value = iter([{"status": "Pulling from test"}, {"error": "manifest unknown"}])
     assert report.is_supported_image() is False
-    debmonitor.logger.error.assert_called_with(
-        "Failed to pull/create image %s: %s", report.image, report.client.containers.create.side_effect
-    )
+    assert api.create_container.call_count == 0
+    message = "Failed to pull/create image {0}: Failed to pull {0}: manifest unknown".format(report.image)
+    assert caplog.record_tuples[-1] == (debmonitor.logger.name, logging.ERROR, message)
+
+
+@pytest.mark.parametrize(
+    "fail_attr, created",
+    [
+        ("get_archive", True),
+        ("pull", False),
+        ("create_container", False),
+    ],
+)
+def test_is_supported_image_error(report, caplog, fail_attr, created):
+    """Docker errors make the image unsupported"""
+    api = report.client.api
+    api.inspect_image.side_effect = docker_errors.ImageNotFound("whatever")
+    api.create_container.return_value = {"Id": "abcd"}
+    error = docker_errors.NotFound("whatever")
+    getattr(api, fail_attr).side_effect = error
+    assert report.is_supported_image() is False
+    if created:
+        # The container is cleaned up
+        api.remove_container.assert_called_with("abcd", force=True)
+        assert not [r for r in caplog.records if r.levelno >= logging.ERROR]
+    else:
+        assert api.remove_container.call_count == 0
+        message = "Failed to pull/create image {}: {}".format(report.image, error)
+        assert caplog.record_tuples[-1] == (debmonitor.logger.name, logging.ERROR, message)
 
 
 @mock.patch("docker_report.debmonitor.DockerReport")
 def test_main(mocker):
     with pytest.raises(SystemExit) as se:
         debmonitor.main(["--keep", "image", "dir"])
-        assert se.code == 0
-    mocker.assert_called_with("image", "dir", 10)
+    assert se.value.code == 0
+    mocker.assert_called_with("image", "dir", 10, force_pull=False)
     mocker.return_value.generate_report.assert_called_with()
     mocker.return_value.submit_report.assert_called_with()
 
 
-@mock.patch("docker_report.debmonitor.DockerReport.is_supported_image")
-@mock.patch("docker_report.debmonitor.DockerReport._cmd")
-@mock.patch("docker.from_env", lambda: None)
-def test_main_not_ok(mocker, is_supported_image_mock):
-    is_supported_image_mock.return_value = True
-    # Case 1: expected exception
-    mocker.side_effect = debmonitor.DockerReportError("fail")
-    with pytest.raises(SystemExit) as se:
-        debmonitor.main(["--keep", "image", "dir"])
-        assert se.code == 1
-
-
-@mock.patch("docker_report.debmonitor.DockerReport.is_supported_image")
-@mock.patch("docker_report.debmonitor.DockerReport._cmd")
-@mock.patch("docker.from_env", lambda: None)
-def test_main_unexpected(mocker, is_supported_image_mock):
-    is_supported_image_mock.return_value = True
-    # Case 2: unexpected exception
-    mocker.side_effect = Exception("fail")
-    with pytest.raises(SystemExit) as se:
-        debmonitor.main(["--keep", "image", "dir"])
-        assert se.code == 2
-
-
-@mock.patch("docker_report.debmonitor.DockerReport.is_supported_image")
-@mock.patch("shutil.rmtree")
-@mock.patch("docker_report.debmonitor.DockerReport._cmd")
-@mock.patch("docker.from_env", lambda: None)
-def test_main_removal(cmd, rmtree, is_supported_image_mock):
-    """Test the file is removed with the right cli options"""
-    is_supported_image_mock.return_value = True
-    with pytest.raises(SystemExit):
-        debmonitor.main(["image", "/dir"])
-        rmtree.assert_called_with("/dir/image.debmonitor.json", ignore_errors=True)
-
-
-@mock.patch("docker_report.debmonitor.DockerReport.is_supported_image")
-@mock.patch("shutil.rmtree")
-@mock.patch("docker_report.debmonitor.DockerReport._cmd")
-@mock.patch("docker.from_env", lambda: None)
-def test_main_keep(cmd, rmtree, is_supported_image_mock):
-    """Test the file is removed with the right cli options"""
-    is_supported_image_mock.return_value = True
-    with pytest.raises(SystemExit):
-        debmonitor.main(["--keep", "image", "/dir"])
-        assert rmtree.call_count == 0
-
-
-@mock.patch("docker_report.debmonitor.DockerReport.is_supported_image")
-@mock.patch("shutil.rmtree")
-@mock.patch("docker_report.debmonitor.DockerReport._cmd")
-@mock.patch("docker.from_env", lambda: None)
-def test_main_no_submit(cmd, rmtree, is_supported_image_mock):
-    """Test no submission"""
-    is_supported_image_mock.return_value = True
-    report = debmonitor.DockerReport("image", "/dir", 10)
-    with pytest.raises(SystemExit):
-        debmonitor.main(["--no-submit", "image", "/dir"])
-        assert rmtree.call_count == 0
-    cmd.assert_called_with("Report generation", report._docker_cmd())
-
-
-@mock.patch("docker_report.debmonitor.DockerReport.is_supported_image")
-@mock.patch("docker_report.debmonitor.DockerReport._cmd")
-@mock.patch("docker.from_env", lambda: None)
-def test_main_not_supported_image(cmd, is_supported_image_mock):
-    """Test not supported image"""
-    is_supported_image_mock.return_value = False
-    debmonitor.logger.warning = mock.MagicMock()
-    with pytest.raises(SystemExit) as se:
-        debmonitor.main(["--keep", "image", "dir"])
-        assert se.code == 0
-    debmonitor.logger.warning.assert_called_with(
-        "Unable to create a report for %s. The image is not supported.", "image"
+@pytest.fixture(scope="module")
+def docker_cmd(from_env):
+    """The report generation command for "image", which doesn't depend on the report directory"""
+    return debmonitor.DockerReport("image", "/dir", 10)._docker_cmd()
+
+
+class TestMain:
+    """Run main() with the docker commands mocked."""
+
+    @pytest.fixture(autouse=True)
+    def mocks(self, monkeypatch):
+        ns = SimpleNamespace(
+            cmd=mock.Mock(return_value=b"{}"), rmtree=mock.Mock(), is_supported=mock.Mock(return_value=True)
+        )
+        monkeypatch.setattr(debmonitor.DockerReport, "_cmd", ns.cmd)
+        monkeypatch.setattr(debmonitor.DockerReport, "is_supported_image", ns.is_supported)
+        monkeypatch.setattr(debmonitor.shutil, "rmtree", ns.rmtree)
+        return ns
+
+    def test_main_not_ok(self, mocks):
+        # Case 1: expected exception
+        mocks.cmd.side_effect = debmonitor.DockerReportError("fail")
+        with pytest.raises(SystemExit) as se:
+            debmonitor.main(["--keep", "image", "dir"])
+        assert se.value.code == 1
+
+    def test_main_unexpected(self, mocks):
+        # Case 2: unexpected exception
+        mocks.cmd.side_effect = Exception("fail")
+        with pytest.raises(SystemExit) as se:
+            debmonitor.main(["--keep", "image", "dir"])
+        assert se.value.code == 2
+
+    @pytest.mark.parametrize(
+        "flags, removed, submitted",
+        [
+            ([], True, True),  # The report is submitted, then removed
+            (["--keep"], False, True),  # The report is submitted and kept
+            (["--no-submit"], False, False),  # The report is only generated
+        ],
     )
+    def test_main_flags(self, mocks, docker_cmd, tmp_path, flags, removed, submitted):
+        """Test the report is submitted and removed according to the cli options"""
+        filename = str(tmp_path / "image.debmonitor.json")
+        with pytest.raises(SystemExit) as se:
+            debmonitor.main(flags + ["image", str(tmp_path)])
+        assert se.value.code == 0
+        if removed:
+            mocks.rmtree.assert_called_once_with(filename, ignore_errors=True)
+        else:
+            assert mocks.rmtree.call_count == 0
+        expected = [mock.call("Report generation", docker_cmd)]
+        if submitted:
+            expected.append(mock.call("Submit report", ["debmonitor-client-unpriv", "-f", filename]))
+        assert mocks.cmd.call_args_list == expected
+
+    def test_main_not_supported_image(self, mocks, caplog):
+        """Test not supported image"""
+        mocks.is_supported.return_value = False
+        with pytest.raises(SystemExit) as se:
+            debmonitor.main(["--keep", "image", "dir"])
+        assert se.value.code == 0
+        assert mocks.cmd.call_count == 0
+        message = "Unable to create a report for image. The image is not supported."
+        assert caplog.record_tuples[-1] == (debmonitor.logger.name, logging.WARNING, message)
+
+
+def test_docker_client_shared(from_env):
+    first = debmonitor.DockerReport("image", "/dir", 10)
+    second = debmonitor.DockerReport("other", "/dir", 10)
+    assert first.client is second.client
+    from_env.assert_called_once_with()
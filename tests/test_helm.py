@@ -1,5 +1,6 @@
 import pytest
 import subprocess
+from io import BytesIO
 from pathlib import Path
 from unittest import mock
 
@@ -24,14 +25,51 @@ tillerVersion: ">=2.8"
 """
 
 
-@mock.patch.object(Path, "open", new_callable=mock.mock_open, read_data=chart_yaml_data)
-def test_get_chart_name_version(open_mock):
+@pytest.fixture(autouse=True)
+def chart_cache():
+    """Don't share parsed charts between tests"""
+    helm._chart_name_version.cache_clear()
+
+
+@pytest.fixture
+def open_mock(monkeypatch):
+    """Serve chart_yaml_data as the content of the opened Chart.yaml"""
+    opener = mock.Mock(side_effect=lambda: BytesIO(chart_yaml_data))
+    monkeypatch.setattr(Path, "open", opener)
+    return opener
+
+
+@pytest.fixture
+def stat_mock():
+    with mock.patch.object(Path, "stat") as stat:
+        stat.return_value.st_mtime_ns = 1594156344000000000
+        stat.return_value.st_size = len(chart_yaml_data)
+        yield stat
+
+
+def test_get_chart_name_version(open_mock, stat_mock):
     assert helm.get_chart_name_version(Path("foo/path/Chart.yaml")) == ("blubberoid", "0.0.26")
     open_mock.assert_called_once_with()
 
 
-@mock.patch.object(Path, "open", new_callable=mock.mock_open, read_data=b"aa:1")
-def test_get_chart_name_version_error(open_mock):
+def test_get_chart_name_version_cached(open_mock, stat_mock):
+    """The file is parsed again only if it changed"""
+    for _ in range(3):
+        assert helm.get_chart_name_version(Path("foo/path/Chart.yaml")) == ("blubberoid", "0.0.26")
+    assert open_mock.call_count == 1
+    stat_mock.return_value.st_mtime_ns += 1
+    helm.get_chart_name_version(Path("foo/path/Chart.yaml"))
+    assert open_mock.call_count == 2
+
+
+def test_get_chart_name_version_no_libyaml(open_mock, stat_mock, monkeypatch):
+    """Without libyaml, fall back to the pure-python loader"""
+    monkeypatch.delattr("yaml.CSafeLoader", raising=False)
+    assert helm.get_chart_name_version(Path("foo/path/Chart.yaml")) == ("blubberoid", "0.0.26")
+
+
+def test_get_chart_name_version_error(open_mock, stat_mock):
+    open_mock.side_effect = lambda: BytesIO(b"aa:1")
     with pytest.raises(helm.ChartError):
         helm.get_chart_name_version(Path("foo/path/Chart.yaml"))
 
@@ -43,7 +81,18 @@ def test_package_cmd_ok(subprocess_mock, isfile_mock, mkdtemp_mock):
     """Test that a normal command will report its results"""
     subprocess_mock.return_value = b"Successfully packaged chart and saved it to: /nonexistent/zotero-0.0.16.tgz\n"
     isfile_mock.return_value = True
-    helm.package_chart(Path("foo_ok"))
+    assert helm.package_chart(Path("foo_ok")) == Path("/nonexistent/zotero-0.0.16.tgz")
+
+
+@mock.patch("shutil.rmtree")
+@mock.patch("tempfile.mkdtemp", return_value="/nonexistent")
+@mock.patch("subprocess.check_output")
+def test_package_cmd_no_output(subprocess_mock, mkdtemp_mock, rmtree_mock):
+    """If helm doesn't tell us where the chart was saved, raise an error"""
+    subprocess_mock.return_value = b""
+    with pytest.raises(helm.HelmError):
+        helm.package_chart(Path("foo_ok"))
+    rmtree_mock.assert_called_with(Path("/nonexistent"))
 
 
 @mock.patch("tempfile.mkdtemp", return_value="/nonexistent")
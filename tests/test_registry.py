@@ -1,11 +1,19 @@
+import fnmatch
 import json
 import os
 from unittest import mock
 
 import pytest
-import requests_mock
 
-from docker_report.registry import Registry
+from docker_report.registry import Registry, RegistryError, _load_docker_config, glob_matcher, is_naked_tag
+
+
+@pytest.fixture(autouse=True)
+def docker_config():
+    """Don't share the parsed docker config between tests."""
+    _load_docker_config.cache_clear()
+    yield
+    _load_docker_config.cache_clear()
 
 
 @pytest.fixture
@@ -14,6 +22,48 @@ def registry() -> Registry:
     return r
 
 
+@pytest.mark.parametrize(
+    "pattern, value, expected",
+    [
+        ("*", "anything", True),
+        ("l*", "latest", True),
+        ("l*", "atest", False),
+        ("*test", "atest", True),
+        ("2018*", "2018-05-15", True),
+        ("0.?", "0.1", True),
+        ("0.?", "0.10", False),
+        ("[ab]*", "b1", True),
+        ("foo", "foobar", False),
+        ("foo", "foo", True),
+        ("*oob*", "foobar", True),
+        ("*oob*", "foo", False),
+        ("**", "", True),
+        ("l*t", "latest", True),
+        ("*a*t", "latest", True),
+        ("*a*t", "latex", False),
+    ],
+)
+def test_glob_matcher(pattern, value, expected):
+    """Globs are matched like fnmatch does"""
+    assert glob_matcher(pattern)(value) is expected
+    assert fnmatch.fnmatchcase(value, pattern) is expected
+
+
+@pytest.mark.parametrize(
+    "tag, expected",
+    [
+        ("0adab19a3f4d37e2d0487d984273e31595629855", True),
+        ("926952c71ed2b5a94c1b9d52adf70129dfcb4bar", True),
+        ("0adab19a3f4d37e2d0487d984273e31595629855-1", False),
+        ("0adab19a3f4d37e2d0487d984273e3159562985", False),
+        ("0adab19a3f4d37e2d0487d984273e3159562985-", False),
+        ("latest", False),
+    ],
+)
+def test_is_naked_tag(tag, expected):
+    assert is_naked_tag(tag) is expected
+
+
 def test_initialize():
     """Test basic initialization - no auth"""
     rb = Registry("httpbin.org", configfile="test")
@@ -22,70 +72,147 @@ def test_initialize():
 
 
 @pytest.mark.parametrize("authkey", ["httpbin.org", "https://httpbin.org"])
-def test_auth_token(authkey):
-    with mock.patch("json.load") as jl:
-        jl.return_value = {"auths": {authkey: {"auth": "abcd"}}}
-        # This is a trick to ensure the file is present and readable.
-        filename = os.path.abspath(__file__)
-        r = Registry("httpbin.org", configfile=filename)
-        assert r.auth == "abcd"
+def test_auth_token(monkeypatch, authkey):
+    monkeypatch.setattr(json, "load", lambda fh: {"auths": {authkey: {"auth": "abcd"}}})
+    # This is a trick to ensure the file is present and readable.
+    filename = os.path.abspath(__file__)
+    r = Registry("httpbin.org", configfile=filename)
+    assert r.auth == "abcd"
 
 
-def test_auth_token_invalid(registry):
-    with mock.patch("json.load") as jl:
-        jl.side_effect = json.decoder.JSONDecodeError("test", doc="some error", pos=10)
-        assert registry._get_auth_token(__file__) is None
+def test_auth_token_invalid(monkeypatch, registry):
+    jl = mock.Mock(side_effect=json.decoder.JSONDecodeError("test", doc="some error", pos=10))
+    monkeypatch.setattr(json, "load", jl)
+    assert registry._get_auth_token(__file__) is None
 
 
-def test_default_config_file():
-    with mock.patch("docker_report.registry.open", mock.mock_open(read_data="{}")) as m:
-        Registry("httpbin.org")
-        m.assert_called_with(os.path.expanduser("~/.docker/config.json"), "r")
+def test_default_config_file(monkeypatch):
+    m = mock.mock_open(read_data="{}")
+    # open is a builtin, the module has no attribute of its own to replace.
+    monkeypatch.setattr("docker_report.registry.open", m, raising=False)
+    Registry("httpbin.org")
+    m.assert_called_with(os.path.expanduser("~/.docker/config.json"), "r")
 
 
-def test_pagination():
+def test_auth_config_cached(monkeypatch):
+    """The config file is parsed only once for several registries"""
+    filename = os.path.abspath(__file__)
+    jl = mock.Mock(return_value={"auths": {"httpbin.org": {"auth": "abcd"}}})
+    monkeypatch.setattr(json, "load", jl)
+    assert Registry("httpbin.org", configfile=filename).auth == "abcd"
+    assert Registry("example.org", configfile=filename).auth is None
+    jl.assert_called_once()
+
+
+def test_pagination(requests_mock):
     """Test pagination works."""
     browser = Registry("httpbin.org")
-    with requests_mock.Mocker() as m:
-        first_resp = {"repositories": ["bar", "baz", "baz/foo", "foo"]}
-        m.get(
-            "https://httpbin.org/v2/_catalog",
-            headers={"link": '</v2/_catalog?last=foo&n=100>; rel="next"'},
-            json=first_resp,
-        )
-        second_resp = {"repositories": ["test/pinkunicorn"]}
-        m.get("https://httpbin.org/v2/_catalog?last=foo&n=100", json=second_resp)
-        results = browser._get_all_pages("/v2/_catalog")
-        assert {"repositories": ["test/pinkunicorn"]} in results
-
-
-def test_request_auth(registry):
-    registry.auth = "abcd"
-    with requests_mock.Mocker() as m:
-        m.get("https://httpbin.org/v2/_catalog", headers={}, text="fail")
-        m.get("https://httpbin.org/v2/_catalog", headers={"Authentication": "Basic abcd"}, text="ok")
-        assert registry._request("/v2/_catalog").text == "ok"
-
-
-def test_request_no_image_tag(registry):
+    first_resp = {"repositories": ["bar", "baz", "baz/foo", "foo"]}
+    requests_mock.get(
+        "https://httpbin.org/v2/_catalog",
+        headers={"link": '</v2/_catalog?last=foo&n=100>; rel="next"'},
+        json=first_resp,
+    )
+    second_resp = {"repositories": ["test/pinkunicorn"]}
+    requests_mock.get("https://httpbin.org/v2/_catalog?last=foo&n=100", json=second_resp)
+    results = browser._get_all_pages("/v2/_catalog")
+    assert {"repositories": ["test/pinkunicorn"]} in results
+
+
+@pytest.mark.parametrize(
+    "link, pages",
+    [
+        ('</v2/_catalog?last=foo&n=100>; rel="next"', 2),
+        ("</v2/_catalog?last=foo&n=100>;rel=next", 2),
+        ('</v2/_catalog?n=100>; rel="prev"', 1),
+    ],
+)
+def test_pagination_link(registry, link, pages, requests_mock):
+    """Only links to the next page are followed"""
+    requests_mock.get("https://httpbin.org/v2/_catalog", headers={"Link": link}, json={})
+    requests_mock.get("https://httpbin.org/v2/_catalog?last=foo&n=100", json={})
+    assert len(registry._get_all_pages("/v2/_catalog")) == pages
+
+
+def test_get_tags_for_image_pages(registry, requests_mock):
+    """Tags from all the pages are returned"""
+    requests_mock.get(
+        "https://httpbin.org/v2/foo/tags/list",
+        headers={"Link": '</v2/foo/tags/list?last=2&n=2>; rel="next"'},
+        json={"name": "foo", "tags": ["1", "2"]},
+    )
+    requests_mock.get("https://httpbin.org/v2/foo/tags/list?last=2&n=2", json={"name": "foo", "tags": ["3"]})
+    assert registry.get_tags_for_image("foo") == ["1", "2", "3"]
+
+
+def test_iter_tags_for_image_lazy(registry, requests_mock):
+    """The next page of tags is fetched only when the previous one has been consumed"""
+    requests_mock.get(
+        "https://httpbin.org/v2/foo/tags/list",
+        headers={"Link": '</v2/foo/tags/list?last=2&n=2>; rel="next"'},
+        json={"name": "foo", "tags": ["1", "2"]},
+    )
+    requests_mock.get("https://httpbin.org/v2/foo/tags/list?last=2&n=2", json={"name": "foo", "tags": ["3"]})
+    tags = registry.iter_tags_for_image("foo")
+    assert requests_mock.call_count == 0
+    assert [next(tags), next(tags)] == ["1", "2"]
+    assert requests_mock.call_count == 1
+    assert list(tags) == ["3"]
+    assert requests_mock.call_count == 2
+
+
+def test_pagination_bad_json(registry, requests_mock):
+    """A response that is not valid JSON raises a RegistryError"""
+    requests_mock.get("https://httpbin.org/v2/_catalog", text="{not json")
+    with pytest.raises(RegistryError):
+        registry._get_all_pages("/v2/_catalog")
+
+
+def test_request_auth(requests_mock):
+    with mock.patch("docker_report.registry._load_docker_config") as load:
+        load.return_value = {"httpbin.org": {"auth": "abcd"}}
+        registry = Registry("httpbin.org")
+    requests_mock.get("https://httpbin.org/v2/_catalog", text="fail")
+    requests_mock.get("https://httpbin.org/v2/_catalog", request_headers={"Authorization": "Basic abcd"}, text="ok")
+    assert registry._request("/v2/_catalog").text == "ok"
+    assert registry._request("/v2/_catalog", use_v2=True).text == "ok"
+    assert requests_mock.request_history[0].headers["Accept"] == "application/vnd.docker.distribution.manifest.v1+json"
+    assert requests_mock.request_history[1].headers["Accept"] == "application/vnd.docker.distribution.manifest.v2+json"
+    # The token is baked into the headers, so it can't be changed afterwards.
+    with pytest.raises(AttributeError):
+        registry.auth = "efgh"
+
+
+def test_request_no_image_tag(registry, requests_mock):
     """
     Due to https://github.com/docker/distribution/issues/2747, we get images from the catalog
     that return 404 when queried.
 
     So we need to correctly handle that case when getting the tags for an image
     """
-    with requests_mock.Mocker() as m:
-        m.get(
-            "https://httpbin.org/v2/bar/tags/list",
-            status_code=404,
-            json={
-                "errors": [
-                    {
-                        "code": "NAME_UNKNOWN",
-                        "message": "repository name not known to registry",
-                        "detail": {"name": "bar"},
-                    }
-                ]
-            },
-        )
-        assert registry.get_tags_for_image("bar") == []
+    requests_mock.get(
+        "https://httpbin.org/v2/bar/tags/list",
+        status_code=404,
+        json={
+            "errors": [
+                {
+                    "code": "NAME_UNKNOWN",
+                    "message": "repository name not known to registry",
+                    "detail": {"name": "bar"},
+                }
+            ]
+        },
+    )
+    assert registry.get_tags_for_image("bar") == []
+
+
+@mock.patch("docker_report.registry.requests_session")
+def test_session_reused(requests_session):
+    """All requests go through the same session"""
+    r = Registry("httpbin.org")
+    r._request("/v2/_catalog")
+    r._request("/v2/_catalog")
+    assert requests_session.call_count == 1
+    assert requests_session.return_value.request.call_count == 2
+    r.close()
+    requests_session.return_value.close.assert_called_once_with()
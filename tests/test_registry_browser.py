@@ -1,20 +1,31 @@
+from datetime import datetime
 from unittest import mock
 
 import pytest
 import requests
 
 from docker_report.registry import RegistryError
-from docker_report.registry.browser import RegistryBrowser, RegistryBrowserError
+from docker_report.registry.browser import TAGS_PREFETCH, RegistryBrowser, RegistryBrowserError
 
 
 @pytest.fixture
 def browser():
     """A registry browser that will not perform requests"""
     rb = RegistryBrowser("httpbin.org")
-    rb._get_all_pages = mock.MagicMock()
+    rb._iter_pages = mock.MagicMock()
     return rb
 
 
+def test_filters_per_instance():
+    """Filters are not shared between browsers"""
+    rb = RegistryBrowser("httpbin.org", name_filters=[str.isalpha])
+    rb.tag_filters.append(bool)
+    other = RegistryBrowser("httpbin.org")
+    assert rb.name_filters == [str.isalpha]
+    assert other.name_filters == []
+    assert other.tag_filters == []
+
+
 def test_get_images_list(browser):
     """Test retreiving images works"""
 
@@ -25,7 +36,7 @@ def test_get_images_list(browser):
         return "/" not in name
 
     browser.name_filters = [nofoo, nons]
-    browser._get_all_pages.return_value = [
+    browser._iter_pages.return_value = [
         {"repositories": ["bar", "baz", "baz/foo", "foo"]},
         {"repositories": ["test/pinkunicorn"]},
     ]
@@ -33,10 +44,18 @@ def test_get_images_list(browser):
     assert results == ["bar", "baz"]
 
 
+@pytest.mark.parametrize("filters, expected", [([], ["a", "a/b", "c"]), ([str.isalpha], ["a", "c"])])
+def test_get_images_list_few_filters(browser, filters, expected):
+    """Zero or one filter are applied correctly"""
+    browser.name_filters = filters
+    browser._iter_pages.return_value = [{"repositories": ["a", "a/b"]}, {"repositories": ["c"]}]
+    assert browser._get_images_list() == expected
+
+
 def test_get_image_tags(browser):
     """Test retreiving tags for an image works"""
     browser._get_images_list = mock.MagicMock(return_value=["foo", "foo/bar"])
-    browser._get_all_pages.return_value = [{"name": "foo/bar", "tags": ["1", "foo1", "2"]}]
+    browser._iter_pages.return_value = [{"name": "foo/bar", "tags": ["1", "foo1", "2"]}]
 
     def onlynumeric(data):
         return data[0] == "foo/bar" and data[1] in ["1", "2"]
@@ -46,6 +65,60 @@ def test_get_image_tags(browser):
     assert res == {"foo/bar": ["1", "2"]}
 
 
+def test_get_image_tags_order(browser):
+    """Tags fetched in parallel are matched to the right image"""
+    browser._get_images_list = mock.MagicMock(return_value=["foo", "bar", "baz"])
+    mock_responses = {
+        "/v2/foo/tags/list": [{"name": "foo", "tags": ["1"]}],
+        "/v2/bar/tags/list": [{"name": "bar", "tags": []}],
+        "/v2/baz/tags/list": [{"name": "baz", "tags": ["2", "3"]}],
+    }
+    browser._iter_pages.side_effect = mock_responses.get
+    res = browser.get_image_tags()
+    assert res == {"foo": ["1"], "baz": ["2", "3"]}
+    assert list(res) == ["foo", "baz"]
+
+
+def test_iter_image_tags_sorted(browser):
+    """Images are yielded one at a time, sorted with the shared pool"""
+    browser._get_images_list = mock.MagicMock(return_value=["foo", "bar"])
+    browser.get_tags_for_image = mock.MagicMock(return_value=["2", "1"])
+    browser._fetch_tag_date = mock.MagicMock(side_effect=lambda image, tag: datetime(2020, 1, int(tag)))
+    images = browser.iter_image_tags(sort=True)
+    assert next(images) == ("foo", ["1", "2"])
+    assert browser._fetch_tag_date.call_count == 2
+    assert list(images) == [("bar", ["1", "2"])]
+
+
+@pytest.mark.parametrize("sort", [False, True])
+def test_iter_image_tags_prefetch(browser, sort):
+    """Only a few tag lists are fetched ahead of the image being worked on, and none after closing"""
+    browser._get_images_list = mock.MagicMock(return_value=[str(i) for i in range(50)])
+    browser.get_tags_for_image = mock.MagicMock(return_value=["2", "1"])
+    browser._fetch_tag_date = mock.MagicMock(side_effect=lambda image, tag: datetime(2020, 1, int(tag)))
+    images = browser.iter_image_tags(sort=sort)
+    assert next(images) == ("0", ["1", "2"] if sort else ["2", "1"])
+    images.close()
+    assert browser.get_tags_for_image.call_count <= TAGS_PREFETCH + 1
+
+
+def test_get_image_max_tag(browser):
+    """Only the newest tag of each image is returned"""
+    browser._get_images_list = mock.MagicMock(return_value=["foo", "bar", "baz"])
+    tags = {"foo": ["1", "3", "2"], "bar": ["1"], "baz": []}
+    browser.get_tags_for_image = mock.MagicMock(side_effect=tags.get)
+    browser._fetch_tag_date = mock.MagicMock(side_effect=lambda image, tag: datetime(2020, 1, int(tag)))
+    assert list(browser.get_image_max_tag()) == [("foo", "3"), ("bar", "1")]
+    assert browser._fetch_tag_date.call_count == 3
+
+
+def test_newest_tag_same_date(browser):
+    """With the same creation date, the newest tag is the last one sort_tags would return"""
+    browser._fetch_tag_date = mock.MagicMock(return_value=datetime(2020, 1, 1))
+    tags = ["a", "b", "c"]
+    assert browser.newest_tag("test", tags) == browser.sort_tags("test", tags)[-1] == "c"
+
+
 def test_request_error():
     """If a request raises an error, raise a localized exception"""
     rb = RegistryBrowser("httpbin.org")
@@ -58,7 +131,7 @@ def test_get_image_tags_sorted(browser):
     """Test sorting is called."""
     browser.sort_tags = mock.MagicMock(return_value=["fool", "1", "2"])
     browser._get_images_list = mock.MagicMock(return_value=["foo/bar"])
-    browser._get_all_pages.return_value = [{"name": "foo/bar", "tags": ["1", "foo1", "2"]}]
+    browser._iter_pages.return_value = [{"name": "foo/bar", "tags": ["1", "foo1", "2"]}]
     # Sort is not called
     res = browser.get_image_tags()
     assert res["foo/bar"] == ["1", "foo1", "2"]
@@ -68,14 +141,34 @@ def test_get_image_tags_sorted(browser):
 
 def test_sort_tags(browser):
     """Test sorting works"""
-    mock_responses = [
-        [{"history": [{"v1Compatibility": '{"created": "2018-05-15T13:32:36.023166904Z"}'}]}],
-        [{"history": [{"v1Compatibility": '{"created": "2018-04-15T13:32:36.023166904Z"}'}]}],
-    ]
-    browser._get_all_pages.side_effect = mock_responses
+    mock_responses = {
+        "/v2/test/manifests/0.1?cache=busted": [
+            {"history": [{"v1Compatibility": '{"created": "2018-05-15T13:32:36.023166904Z"}'}]}
+        ],
+        "/v2/test/manifests/0.2?cache=busted": [
+            {"history": [{"v1Compatibility": '{"created": "2018-04-15T13:32:36.023166904Z"}'}]}
+        ],
+    }
+    # Manifests are fetched in parallel, so return responses based on the url
+    browser._iter_pages.side_effect = mock_responses.get
     assert browser.sort_tags("test", ["0.1", "0.2"]) == ["0.2", "0.1"]
 
 
+def test_sort_tags_cached(browser):
+    """Creation dates are fetched only once per tag"""
+    browser._fetch_tag_date = mock.MagicMock(side_effect=lambda image, tag: datetime(2020, 1, 10 - int(tag)))
+    assert browser.sort_tags("test", ["1", "2"]) == ["2", "1"]
+    assert browser.sort_tags("test", ["1", "2", "3"]) == ["3", "2", "1"]
+    assert browser._fetch_tag_date.call_count == 3
+
+
+@pytest.mark.parametrize("tags", [[], ["0.1"]])
+def test_sort_tags_trivial(browser, tags):
+    """Nothing is fetched when there's nothing to sort"""
+    assert browser.sort_tags("test", tags) == tags
+    browser._iter_pages.assert_not_called()
+
+
 @pytest.mark.parametrize(
     "response",
     [
@@ -88,6 +181,6 @@ def test_sort_tags(browser):
     ],
 )
 def test_sort_bad_response(browser, response):
-    browser._get_all_pages.return_value = response
+    browser._iter_pages.return_value = response
     with pytest.raises(RegistryBrowserError, match="Could not sort test"):
         browser.sort_tags("test", ["0.1", "0.2"])
@@ -1,8 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
 import pytest
 import requests
-import requests_mock
 
 from docker_report.registry.operations import RegistryOperations
 
@@ -13,66 +13,96 @@ def operations() -> RegistryOperations:
     return r
 
 
-def test_image_digest(operations):
+def test_image_digest(operations, requests_mock):
     """Getting the digest of an image/tag couple works."""
-    with requests_mock.Mocker() as m:
-        m.get(
-            "https://httpbin.org/v2/foobar/manifests/latest",
-            headers={"Docker-Content-Digest": "ok"},
-            request_headers={"Accept": "application/vnd.docker.distribution.manifest.v2+json"},
-        )
-        assert operations._image_digest("foobar", "latest") == "ok"
+    requests_mock.head(
+        "https://httpbin.org/v2/foobar/manifests/latest",
+        headers={"Docker-Content-Digest": "ok"},
+        request_headers={"Accept": "application/vnd.docker.distribution.manifest.v2+json"},
+    )
+    assert operations._image_digest("foobar", "latest") == "ok"
 
 
-def test_image_digest_not_found(operations):
+def test_image_digest_not_found(operations, requests_mock):
     """Getting the digest for a not existent image raises an exception"""
-    with requests_mock.Mocker() as m:
-        m.get("https://httpbin.org/v2/foobar/manifests/latest", status_code=404)
-        with pytest.raises(requests.exceptions.HTTPError):
-            operations._image_digest("foobar", "latest")
+    requests_mock.head("https://httpbin.org/v2/foobar/manifests/latest", status_code=404)
+    with pytest.raises(requests.exceptions.HTTPError):
+        operations._image_digest("foobar", "latest")
 
 
-def test_delete_image(operations):
+def test_delete_image(operations, requests_mock):
     """Deleting a single image works as expected"""
-    operations.get_tags_for_image = mock.MagicMock(return_value=["a", "b", "atest", "latest"])
-    with requests_mock.Mocker() as m:
-        m.get("https://httpbin.org/v2/foobar/manifests/latest", headers={"Docker-Content-Digest": "ok"})
-        m.delete("https://httpbin.org/v2/foobar/manifests/ok", status_code=202)
-        assert operations.delete_image("foobar", "l*") == (["latest"], [], [])
-        assert m.call_count == 2
-        assert m.request_history[1].method == "DELETE"
+    operations.iter_tags_for_image = mock.MagicMock(return_value=["a", "b", "atest", "latest"])
+    requests_mock.head("https://httpbin.org/v2/foobar/manifests/latest", headers={"Docker-Content-Digest": "ok"})
+    requests_mock.delete("https://httpbin.org/v2/foobar/manifests/ok", status_code=202)
+    assert operations.delete_image("foobar", "l*") == (["latest"], [], [])
+    assert requests_mock.call_count == 2
+    assert requests_mock.request_history[1].method == "DELETE"
 
 
-def test_delete_image_no_match(operations):
+def test_delete_image_no_match(operations, requests_mock):
     """If no match is found, nothing happens"""
-    operations.get_tags_for_image = mock.MagicMock(return_value=["a", "b", "atest", "latest"])
-    with requests_mock.Mocker() as m:
-        assert operations.delete_image("foobar", "0.*") == ([], [], [])
-        assert m.call_count == 0
+    operations.iter_tags_for_image = mock.MagicMock(return_value=["a", "b", "atest", "latest"])
+    assert operations.delete_image("foobar", "0.*") == ([], [], [])
+    assert requests_mock.call_count == 0
 
 
-def test_delete_image_no_auth(operations):
+def test_delete_image_no_auth(operations, requests_mock):
     """If an image can't be deleted, it ends up in the failed list"""
-    operations.get_tags_for_image = mock.MagicMock(return_value=["a", "b", "atest", "latest"])
-    with requests_mock.Mocker() as m:
-        m.get("https://httpbin.org/v2/foobar/manifests/latest", headers={"Docker-Content-Digest": "ok"})
-        m.get("https://httpbin.org/v2/foobar/manifests/atest", headers={"Docker-Content-Digest": "ko"})
-        m.delete("https://httpbin.org/v2/foobar/manifests/ok", status_code=202)
-        m.delete("https://httpbin.org/v2/foobar/manifests/ko", status_code=401)
-        selected, failed, not_found = operations.delete_image("foobar", "*test")
+    operations.iter_tags_for_image = mock.MagicMock(return_value=["a", "b", "atest", "latest"])
+    requests_mock.head("https://httpbin.org/v2/foobar/manifests/latest", headers={"Docker-Content-Digest": "ok"})
+    requests_mock.head("https://httpbin.org/v2/foobar/manifests/atest", headers={"Docker-Content-Digest": "ko"})
+    requests_mock.delete("https://httpbin.org/v2/foobar/manifests/ok", status_code=202)
+    requests_mock.delete("https://httpbin.org/v2/foobar/manifests/ko", status_code=401)
+    selected, failed, not_found = operations.delete_image("foobar", "*test")
     assert set(selected) == set(["atest", "latest"])
     assert failed == ["atest"]
     assert not_found == []
 
 
-def test_delete_image_tag_gone(operations):
+def test_delete_image_tag_gone(operations, requests_mock):
     """If an image can't be deleted, it ends up in the failed list"""
-    operations.get_tags_for_image = mock.MagicMock(return_value=["0.0.1", "latest"])
-    with requests_mock.Mocker() as m:
-        m.get("https://httpbin.org/v2/foobar/manifests/0.0.1", headers={"Docker-Content-Digest": "ko"})
-        m.delete("https://httpbin.org/v2/foobar/manifests/ko", status_code=200)
-        m.get("https://httpbin.org/v2/foobar/manifests/latest", status_code=404)
-        selected, failed, not_found = operations.delete_image("foobar", "*")
+    operations.iter_tags_for_image = mock.MagicMock(return_value=["0.0.1", "latest"])
+    requests_mock.head("https://httpbin.org/v2/foobar/manifests/0.0.1", headers={"Docker-Content-Digest": "ko"})
+    requests_mock.delete("https://httpbin.org/v2/foobar/manifests/ko", status_code=200)
+    requests_mock.head("https://httpbin.org/v2/foobar/manifests/latest", status_code=404)
+    selected, failed, not_found = operations.delete_image("foobar", "*")
     assert set(selected) == set(["0.0.1", "latest"])
     assert failed == []
     assert not_found == ["latest"]
+
+
+def test_delete_image_literal(operations, requests_mock):
+    """A tag without glob characters is deleted without listing the tags of the image"""
+    operations.iter_tags_for_image = mock.MagicMock()
+    requests_mock.head("https://httpbin.org/v2/foobar/manifests/v1.2.3", headers={"Docker-Content-Digest": "ok"})
+    requests_mock.delete("https://httpbin.org/v2/foobar/manifests/ok", status_code=202)
+    requests_mock.head("https://httpbin.org/v2/foobar/manifests/v1.2.4", status_code=404)
+    assert operations.delete_image("foobar", "v1.2.3") == (["v1.2.3"], [], [])
+    assert operations.delete_image("foobar", "v1.2.4") == (["v1.2.4"], [], ["v1.2.4"])
+    operations.iter_tags_for_image.assert_not_called()
+
+
+def test_delete_image_preselected(operations):
+    """Preselected tags are not fetched again"""
+    operations.iter_tags_for_image = mock.MagicMock()
+    operations._delete_one = mock.MagicMock(return_value="ok")
+    assert operations.delete_image("foobar", "l*", preselected_tags=["latest"]) == (["latest"], [], [])
+    operations.iter_tags_for_image.assert_not_called()
+    operations._delete_one.assert_called_once_with("foobar", "latest")
+
+
+def test_delete_image_order(operations):
+    """Results of the parallel deletions keep the order of the tags"""
+    operations.iter_tags_for_image = mock.MagicMock(return_value=["1", "2", "3", "4"])
+    operations._delete_one = mock.MagicMock(side_effect=lambda name, tag: {"2": "failed"}.get(tag, "not_found"))
+    assert operations.delete_image("foobar", "*") == (["1", "2", "3", "4"], ["2"], ["1", "3", "4"])
+
+
+def test_delete_image_concurrency(operations, monkeypatch):
+    """The number of parallel deletions can be chosen"""
+    pool = mock.Mock(wraps=ThreadPoolExecutor)
+    monkeypatch.setattr("docker_report.registry.operations.ThreadPoolExecutor", pool)
+    operations._delete_one = mock.MagicMock(return_value="ok")
+    assert operations.delete_image("foobar", "*", preselected_tags=["1", "2"], concurrency=2) == (["1", "2"], [], [])
+    pool.assert_called_once_with(max_workers=2)
@@ -28,17 +28,40 @@ def test_parse_args_delete_tags():
     assert options.image_name == "foo/bar"
 
 
+def test_parse_args_reuses_parser():
+    """The parser is built once, and each call still gets its own options"""
+    first = registryctl.parse_args(["delete-tags", "--force", "httpbin.org/foo:1.*"])
+    second = registryctl.parse_args(["list-images", "httpbin.org"])
+    assert registryctl._parser.cache_info().currsize == 1
+    assert first.force and first.select == "1.*"
+    assert not hasattr(second, "force")
+    assert second.select == "*"
+
+
+@pytest.mark.parametrize(
+    "tag, expected",
+    [
+        ("926952c71ed2b5a94c1b9d52adf70129dfcb4bar", False),
+        ("926952c71ed2b5a94c1b9d52adf70129dfcb4ba", True),
+        ("926952c71ed2b5a94c1b9d52adf70129dfcb-bar", True),
+        ("latest", True),
+    ],
+)
+def test_exclude_naked(tag, expected):
+    assert registryctl.exclude_naked(("foo", tag)) is expected
+
+
 @mock.patch("docker_report.registry.browser.RegistryBrowser")
 def test_list_images(base_mocker):
     browser = base_mocker.return_value
-    browser.name_filters = []
-    browser.image_filters = []
     browser.get_image_tags.return_value = {"a": ["b", "c"]}
     registryctl.list_images("httpbin.org", "b*")
-    assert len(browser.name_filters) == 1
-    assert browser.name_filters[0]("b")
-    assert not browser.name_filters[0]("c")
-    assert browser.tag_filters[0]("b")
+    name_filters = base_mocker.call_args.kwargs["name_filters"]
+    tag_filters = base_mocker.call_args.kwargs["tag_filters"]
+    assert len(name_filters) == 1
+    assert name_filters[0]("b")
+    assert not name_filters[0]("c")
+    assert tag_filters[0](("a", "b"))
 
 
 @mock.patch("sys.stdout", new_callable=io.StringIO)
@@ -46,7 +69,7 @@ def test_list_tags(fake_stdout):
     with mock.patch("docker_report.registry.operations.RegistryOperations") as base_mocker:
         ops = base_mocker.return_value
         # Last tag is a fake sha1 to check it doesn't appear in the output.
-        ops.get_tags_for_image.return_value = ["foo", "foobar", "boofar", "926952c71ed2b5a94c1b9d52adf70129dfcb4bar"]
+        ops.iter_tags_for_image.return_value = ["foo", "foobar", "boofar", "926952c71ed2b5a94c1b9d52adf70129dfcb4bar"]
         registryctl.list_tags("httpbin.org", "test", "*bar")
     assert "  - foobar" in fake_stdout.getvalue()
     assert "boofar" not in fake_stdout.getvalue()
@@ -59,27 +82,27 @@ def test_delete_tags_force(base_mocker):
     ops.delete_image.return_value = (["foo", "foobar"], ["foobar"], [])
     # Even if images fail, exit code is always 0 with force.
     registryctl.delete_tags("httpbin.org", "test", "foo*", True)
-    assert ops.get_tags_for_image.call_count == 0
-    ops.delete_image.assert_called_with("test", "foo*")
+    assert ops.iter_tags_for_image.call_count == 0
+    ops.delete_image.assert_called_with("test", "foo*", preselected_tags=None)
 
 
 @mock.patch("docker_report.registry.operations.RegistryOperations")
 def test_delete_tags(base_mocker):
     ops = base_mocker.return_value
-    ops.get_tags_for_image.return_value = ["foo", "foobar", "boofar"]
+    ops.iter_tags_for_image.return_value = ["foo", "foobar", "boofar"]
     ops.delete_image.return_value = (["foo", "foobar"], ["foobar"], [])
     with mock.patch("builtins.input") as i:
         i.return_value = "y"
         with pytest.raises(registryctl.RegistryError):
             registryctl.delete_tags("httpbin.org", "test", "foo*", False)
-    ops.get_tags_for_image.assert_called_with("test")
-    ops.delete_image.assert_called_with("test", "foo*")
+    ops.iter_tags_for_image.assert_called_with("test")
+    ops.delete_image.assert_called_with("test", "foo*", preselected_tags=["foo", "foobar"])
 
 
 @mock.patch("docker_report.registry.operations.RegistryOperations")
 def test_delete_tags_abort(base_mocker):
     ops = base_mocker.return_value
-    ops.get_tags_for_image.return_value = ["foo", "foobar", "boofar"]
+    ops.iter_tags_for_image.return_value = ["foo", "foobar", "boofar"]
     with mock.patch("builtins.input") as i:
         i.return_value = "n"
         registryctl.delete_tags("httpbin.org", "test", "foo*", False)
@@ -90,13 +113,25 @@ def test_delete_tags_abort(base_mocker):
 def test_delete_tags_single(base_mocker):
     """Test deleting a single image doesn't require confirmation"""
     ops = base_mocker.return_value
-    ops.get_tags_for_image.return_value = ["foo", "foobar", "boofar"]
+    ops.iter_tags_for_image.return_value = ["foo", "foobar", "boofar"]
     ops.delete_image.return_value = (["foobar"], [], [])
     with mock.patch("builtins.input") as i:
         i.return_value = "n"
         registryctl.delete_tags("httpbin.org", "test", "*bar", False)
     assert i.call_count == 0
-    ops.delete_image.assert_called_with("test", "*bar")
+    ops.delete_image.assert_called_with("test", "*bar", preselected_tags=["foobar"])
+
+
+@mock.patch("docker_report.registry.operations.RegistryOperations")
+def test_delete_tags_literal(base_mocker):
+    """A tag without glob characters is deleted without listing the tags or asking for confirmation"""
+    ops = base_mocker.return_value
+    ops.delete_image.return_value = (["foobar"], [], [])
+    with mock.patch("builtins.input") as i:
+        registryctl.delete_tags("httpbin.org", "test", "foobar", False)
+    assert i.call_count == 0
+    assert ops.iter_tags_for_image.call_count == 0
+    ops.delete_image.assert_called_with("test", "foobar", preselected_tags=None)
 
 
 @mock.patch("docker_report.registryctl.list_images")
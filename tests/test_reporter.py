@@ -1,8 +1,10 @@
 import io
 import os
+import re
 import shutil
 import stat
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
 import pytest
@@ -13,8 +15,6 @@ from docker_report.registry.browser import RegistryBrowser
 
 @pytest.fixture
 def browser(request) -> RegistryBrowser:
-    RegistryBrowser.tag_filters = []
-    RegistryBrowser.name_filters = []
     if not hasattr(request, "param"):
         opts = reporter.parse_args(["httpbin.org"])
     else:
@@ -39,6 +39,8 @@ def test_args_basic():
     assert opts.filter_file is None
     assert opts.exclude_tag_regexp is None
     assert opts.concurrency == 1
+    assert opts.tempdir_base is None
+    assert opts.force_pull is False
 
 
 def test_args_complex():
@@ -58,6 +60,8 @@ def test_setup_exclude_ns(browser):
     # Check the only tag filter filters out sha1s
     assert len(browser.tag_filters) == 1
     assert browser.tag_filters[0](("dummy", "0adab19a3f4d37e2d0487d984273e31595629855")) is False
+    assert browser.tag_filters[0](("dummy", "0adab19a3f4d37e2d0487d984273e31595629855-1"))
+    assert browser.tag_filters[0](("dummy", "latest"))
 
 
 @pytest.mark.parametrize(
@@ -70,11 +74,55 @@ def test_setup_tag_regexp_allow_sha1(browser):
     assert browser.tag_filters[0](("dummy", "latest")) is False
 
 
+@pytest.mark.parametrize("browser", [["--no-exclude-naked", "httpbin.org"]], indirect=True)
+def test_setup_no_tag_filter(browser):
+    """Without naked tags or tag regexes to exclude, there's no tag filter at all."""
+    assert browser.tag_filters == []
+
+
+@pytest.mark.parametrize(
+    "patterns",
+    [
+        ["latest|^test-"],
+        ["latest", "^test-"],
+        ["latest", "(?i)^TEST-"],
+        ["latest", r"^(t)es\1-"],
+    ],
+)
+def test_matches_any(patterns):
+    """Regexes are matched the same way, whether they can be combined or not."""
+    matches = reporter._matches_any(patterns)
+    assert matches("latest")
+    assert matches("test-1")
+    assert not matches("1.0")
+
+
+def test_matches_any_flags_not_shared():
+    """Inline flags of a regex don't apply to the others."""
+    matches = reporter._matches_any(["latest", "(?i)^test-"])
+    assert matches("TEST-1")
+    assert not matches("LATEST")
+
+
+def test_matches_any_invalid():
+    with pytest.raises(re.error):
+        reporter._matches_any(["latest", "[invalid"])
+
+
+@pytest.mark.parametrize("browser", [["--exclude-tag-regexp", "latest", "^test-", "--", "httpbin.org"]], indirect=True)
+def test_setup_tag_regexp_exclude_naked(browser):
+    """Naked tags and tag regexes are excluded by a single filter."""
+    assert len(browser.tag_filters) == 1
+    assert browser.tag_filters[0](("dummy", "0adab19a3f4d37e2d0487d984273e31595629855")) is False
+    assert browser.tag_filters[0](("dummy", "0adab19a3f4d37e2d0487d984273e31595629855-1"))
+    assert browser.tag_filters[0](("dummy", "latest")) is False
+    assert browser.tag_filters[0](("dummy", "test-1")) is False
+    assert browser.tag_filters[0](("dummy", "1.0"))
+
+
 @mock.patch("docker_report.reporter._filters_from_file")
 def test_setup_filters_from_file(mocker):
     mocker.return_value = ([lambda x: "foo/" not in x], [lambda data: data[1] != "latest"])
-    RegistryBrowser.tag_filters = []
-    RegistryBrowser.name_filters = []
     opts = reporter.parse_args(["--filter-file", "test.ini", "httpbin.org"])
     br = reporter.setup_browser(opts)
     mocker.assert_called_with("test.ini")
@@ -121,6 +169,82 @@ action = include
     assert tag[0](arg) and tag[1](arg)
 
 
+def test_filters_from_file_single_exclusion_literal():
+    """A single contains: exclusion rule is checked without the regex engine"""
+    configfile = b"""
+[no_devel_ns]
+name = contains:wmf-devel.
+action = exclude
+"""
+    with mock.patch("configparser.ConfigParser.read", monkey_patch_read), mock.patch("re.compile") as compile:
+        name, tag = reporter._filters_from_file(configfile)
+    compile.assert_not_called()
+    assert name[0]("foo/wmf-devel.x") is False
+    assert name[0]("foo/wmf-develx")
+
+
+def test_filters_from_file_exclusions_fused():
+    """All the image exclusion rules are checked by a single filter"""
+    configfile = b"""
+[no_devel_ns]
+name = contains:devel/
+action = exclude
+
+[no_debug]
+name = regex:-debug$
+action = exclude
+
+[no_dotted]
+name = contains:a.b
+action = exclude
+
+[only_wmf]
+name = regex:^wmf/
+action = include
+"""
+    with mock.patch("configparser.ConfigParser.read", monkey_patch_read):
+        name, tag = reporter._filters_from_file(configfile)
+    assert len(name) == 2
+    assert tag == []
+
+    def allowed(image):
+        return all(f(image) for f in name)
+
+    assert allowed("wmf/foo")
+    assert not allowed("other/foo")
+    assert not allowed("wmf/devel/foo")
+    assert not allowed("wmf/foo-debug")
+    assert not allowed("wmf/a.b")
+    assert allowed("wmf/axb")
+
+
+@pytest.mark.parametrize("pattern", ["foo", "^foo", "foo$", "^foo$", "", "fo+", "^f.o$", "foo\\$", "a|foo"])
+def test_parse_rule_literal(pattern):
+    """Literal regexes are compared as plain strings, with the same results"""
+    regex = re.compile(pattern)
+    rule = reporter._parse_rule("regex:" + pattern)
+    for name in ["foo", "foobar", "barfoo", "barfoobar", "bar", "", "foo$", "fooo"]:
+        assert rule(name) is (regex.search(name) is not None)
+
+
+def test_filters_from_file_cached(tmp_path):
+    """A filter file is parsed again only when it changes"""
+    filter_file = tmp_path / "filters.ini"
+    filter_file.write_text("[no_devel]\nname = contains:devel\naction = exclude\n")
+    with mock.patch("docker_report.reporter._parse_filters_file", wraps=reporter._parse_filters_file) as parse:
+        first = reporter._filters_from_file(str(filter_file))
+        second = reporter._filters_from_file(str(filter_file))
+        assert parse.call_count == 1
+        assert first == second
+        assert first[0] is not second[0]
+        assert second[0][0]("devel/foo") is False
+        filter_file.write_text("[no_debug]\nname = contains:debug\naction = exclude\n")
+        os.utime(str(filter_file), ns=(0, 0))
+        third = reporter._filters_from_file(str(filter_file))
+        assert parse.call_count == 2
+        assert third[0][0]("debug/foo") is False
+
+
 def test_filters_from_file_invalid():
     """An invalid rule gets ignored"""
     configfile = b"""
@@ -187,6 +311,14 @@ def test_tempdir(gr):
     shutil.rmtree(tmpdir)
 
 
+@mock.patch("grp.getgrnam")
+def test_tempdir_base(gr, tmp_path):
+    """The tempdir can be created in a specific directory."""
+    gr.return_value.gr_gid = os.getgid()
+    tmpdir = reporter._tempdir(base_dir=str(tmp_path))
+    assert os.path.dirname(tmpdir) == str(tmp_path)
+
+
 def test_reporter_init(rep):
     """Initialize the reporter"""
     assert rep._prune_images
@@ -196,7 +328,7 @@ def test_reporter_init(rep):
 @mock.patch("docker_report.reporter.DockerReport")
 def test_run_report(dr, rep):
     rep.run_report("example.org/test:latest")
-    dr.assert_called_with("example.org/test:latest", "/tmp", 10)
+    dr.assert_called_with("example.org/test:latest", "/tmp", 10, force_pull=False)
     debmonitor = dr.return_value
     debmonitor.generate_report.assert_called_with()
     debmonitor.submit_report.assert_called_with()
@@ -204,6 +336,28 @@ def test_run_report(dr, rep):
     assert rep.exitcode == 0
 
 
+@mock.patch("docker_report.reporter.DockerReport")
+def test_run_report_force_pull(dr):
+    """With --force-pull, images are pulled even if a (possibly stale) local copy exists"""
+    br = mock.MagicMock()
+    br.registry_url = "example.org"
+    rep = reporter.Reporter(br, "/tmp", False, 10, force_pull=True)
+    rep.run_report("example.org/test:latest")
+    dr.assert_called_with("example.org/test:latest", "/tmp", 10, force_pull=True)
+
+
+@mock.patch("docker_report.reporter.Reporter")
+def test_main_force_pull(rep):
+    """The --force-pull option is passed on to the reporter"""
+    rep.return_value.get_images.return_value = []
+    rep.return_value.exitcode = 0
+    with mock.patch("docker_report.reporter._tempdir") as td:
+        td.return_value = tempfile.mkdtemp()
+        with pytest.raises(SystemExit):
+            reporter.main(["--force-pull", "example.org"])
+    assert rep.call_args.kwargs["force_pull"] is True
+
+
 @mock.patch("docker_report.reporter.DockerReport")
 def test_run_report_keep(dr, rep):
     rep._prune_images = False
@@ -219,13 +373,13 @@ def test_run_report_exception(dr, rep):
 
 
 def test_get_images(rep):
-    rep._browser.get_image_tags.return_value = {"test": ["1", "3", "latest"]}
+    rep._browser.get_image_max_tag.return_value = iter([("test", "latest")])
     assert list(rep.get_images()) == ["example.org/test:latest"]
     assert rep.exitcode == 0
 
 
 def test_get_images_error(rep):
-    rep._browser.get_image_tags.side_effect = reporter.RegistryError("fail!")
+    rep._browser.get_image_max_tag.side_effect = reporter.RegistryError("fail!")
     assert list(rep.get_images()) == []
     assert rep.exitcode == 2
 
@@ -244,6 +398,7 @@ def test_pprint_fail(stdout, rep):
     rep._success = ["abc"]
     rep.pprint()
     assert "All images submitted correctly!" not in stdout.getvalue()
+    assert stdout.getvalue().splitlines() == ["", "Detailer results:", "%-70s[OK]" % "abc", "%-68s[FAIL]" % "cde"]
 
 
 @mock.patch("docker_report.reporter.Reporter")
@@ -273,3 +428,31 @@ def test_main_exception(rep):
     assert not os.path.isdir(td.return_value)
     assert instance.run_report.call_count == 1
     assert exc_info.value.code == 1
+
+
+def test_run_reports_bounded():
+    """No more than max_pending reports are waiting at any time"""
+    report = mock.MagicMock()
+    report.get_images.return_value = ["img{}".format(i) for i in range(10)]
+    running = []
+
+    def run_report(image):
+        running.append(image)
+
+    report.run_report.side_effect = run_report
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with mock.patch("docker_report.reporter.wait", wraps=reporter.wait) as wait:
+            reporter._run_reports(executor, report, 3)
+    assert sorted(running) == sorted(report.get_images.return_value)
+    for call in wait.call_args_list:
+        assert len(call.args[0]) == 3
+
+
+@mock.patch("docker_report.reporter.shutil.rmtree")
+def test_main_no_tempdir(rmtree):
+    with mock.patch("docker_report.reporter._tempdir") as td:
+        td.side_effect = KeyError("getgrnam(): name not found: 'debmonitor'")
+        with pytest.raises(SystemExit) as exc_info:
+            reporter.main(["example.org"])
+    assert exc_info.value.code == 1
+    rmtree.assert_not_called()